@@ -11,6 +11,10 @@ _ENABLE_GUI = "--gui" in sys.argv
 # which displays logs itself.
 _DISABLE_CONSOLE_LOG = True
 
+# Make each entity a builtin with its name, so you can just type s1 (for
+# example) at the console.
+_BUILTIN_NAMES = True
+
 from rip_router import RIPRouter as switch
 
 import sim.core
@@ -10,6 +10,10 @@ _ENABLE_GUI = "--gui" in sys.argv
 # which displays logs itself.
 _DISABLE_CONSOLE_LOG = True
 
+# Make each entity a builtin with its name, so you can just type s1 (for
+# example) at the console.
+_BUILTIN_NAMES = True
+
 
 # from hub import Hub as switch
 from rip_router import RIPRouter as switch
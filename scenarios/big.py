@@ -79,25 +79,25 @@ def create (switch_type = RIPRouter, host_type = BasicHost):
        /  \      /     \    \    
     h1b    --s3--       s8--s9--h2b
     """
-    switch_type.create('s1')
-    switch_type.create('s2')
-    switch_type.create('s3')
-    switch_type.create('s4')
-    switch_type.create('s5')
+    s1 = switch_type.create('s1')
+    s2 = switch_type.create('s2')
+    s3 = switch_type.create('s3')
+    s4 = switch_type.create('s4')
+    s5 = switch_type.create('s5')
 
-    switch_type.create('s6')
-    switch_type.create('s7')
-    switch_type.create('s8')
-    switch_type.create('s9')
+    s6 = switch_type.create('s6')
+    s7 = switch_type.create('s7')
+    s8 = switch_type.create('s8')
+    s9 = switch_type.create('s9')
 
 
-    host_type.create('h1a')
-    host_type.create('h1b')
-    host_type.create('h2a')
-    host_type.create('h2b')
+    h1a = host_type.create('h1a')
+    h1b = host_type.create('h1b')
+    h2a = host_type.create('h2a')
+    h2b = host_type.create('h2b')
 
 
-    ReceiveEntity.create('sneakylistener', [s7, s9, s8, s6, s2, s5, s4, s1] , [h1a, 1], 5)
+    sneakylistener = ReceiveEntity.create('sneakylistener', [s7, s9, s8, s6, s2, s5, s4, s1] , [h1a, 1], 5)
 
     topo.link(sneakylistener, h1a)
     topo.link(sneakylistener, s1)
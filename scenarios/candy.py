@@ -14,16 +14,16 @@ def create (switch_type = Hub, host_type = BasicHost):
     h1b    --s3--    h2b
     """
 
-    switch_type.create('s1')
-    switch_type.create('s2')
-    switch_type.create('s3')
-    switch_type.create('s4')
-    switch_type.create('s5')
+    s1 = switch_type.create('s1')
+    s2 = switch_type.create('s2')
+    s3 = switch_type.create('s3')
+    s4 = switch_type.create('s4')
+    s5 = switch_type.create('s5')
 
-    host_type.create('h1a')
-    host_type.create('h1b')
-    host_type.create('h2a')
-    host_type.create('h2b')
+    h1a = host_type.create('h1a')
+    h1b = host_type.create('h1b')
+    h2a = host_type.create('h2a')
+    h2b = host_type.create('h2b')
 
     topo.link(s1, h1a)
     topo.link(s1, h1b)
@@ -1,5 +1,7 @@
 import core
-from random import random as rand
+import itertools
+import array
+import sys
 
 # There is one instance of this: NullAddress
 # It can be used for non-routable packets and such.  It has the
@@ -32,6 +34,15 @@ def create_timer (seconds, target, recurring = True, pass_self = False,
 									 passSelf=pass_self, args=args, kw=kw)
 
 
+def current_time ():
+	 """
+	 Returns the current simulation time in seconds.
+	 Use this instead of time.time() -- when the simulator is running in
+	 virtual time, the two have nothing to do with each other.
+	 """
+	 return core.world.now()
+
+
 def hsv_to_rgb (h, s, v, a = 1):
   """
   Convert hue, saturation, value (0..1) to RGBA.
@@ -52,7 +63,138 @@ def hsv_to_rgb (h, s, v, a = 1):
   return [r,g,b,a]
 
 
+class Trace (object):
+  """
+  Where a packet has been: the entities it went through, in order.
+  It works like a list of them, but is kept as their IDs (which is much
+  smaller), and they're only looked up when someone looks.
+  """
+  __slots__ = ('_hops',)
+
+  def __init__ (self, entities = ()):
+    self._hops = array.array('i', [e._serial for e in entities])
+
+  def append (self, entity):
+    self._hops.append(entity._serial)
+
+  def __len__ (self):
+    return len(self._hops)
+
+  def __iter__ (self):
+    find = core.entities.by_id
+    return (find(s) for s in self._hops)
+
+  def __getitem__ (self, index):
+    if isinstance(index, slice):
+      return list(self)[index]
+    return core.entities.by_id(self._hops[index])
+
+  def __contains__ (self, entity):
+    return getattr(entity, '_serial', None) in self._hops
+
+  def __eq__ (self, other):
+    return list(self) == list(other)
+
+  def __ne__ (self, other):
+    return not self == other
+
+  def __add__ (self, other):
+    return list(self) + list(other)
+
+  def __radd__ (self, other):
+    return list(other) + list(self)
+
+  def __repr__ (self):
+    return repr(list(self))
+
+  def __str__ (self):
+    return ','.join(e.name for e in self)
+
+
+class _NoTrace (Trace):
+  """ The (empty) trace of a packet whose path isn't being recorded. """
+  __slots__ = ()
+
+  def __init__ (self):
+    self._hops = array.array('i')
+
+  def append (self, entity):
+    pass
+
+_no_trace = _NoTrace()
+
+# How packets are traced: 'full' (every packet), 'sampled' (one in every
+# _trace_every packets) or 'off'
+_trace_mode = 'full'
+_trace_every = 100
+_trace_count = itertools.count()
+
+def trace_packets (mode = 'full', every = 100):
+  """
+  Sets which packets keep a trace of where they've been (in .trace):
+   'full'     All of them (the default)
+   'sampled'  One in every /every/ packets
+   'off'      None of them
+  Packets which aren't traced have an empty trace.  Tracing costs memory
+  and time for every hop, so turn it down for big runs that don't need it.
+  It can also be set with _TRACE_PACKETS in __main__.
+  """
+  global _trace_mode, _trace_every
+  if mode not in ('full', 'sampled', 'off'):
+    raise ValueError("Unknown trace mode " + repr(mode))
+  _trace_mode = mode
+  _trace_every = max(1, int(every))
+
+trace_packets(sys.modules['__main__'].__dict__.get("_TRACE_PACKETS", "full"))
+
+def _new_trace ():
+  if _trace_mode == 'full':
+    return Trace()
+  if _trace_mode == 'sampled' and next(_trace_count) % _trace_every == 0:
+    return Trace()
+  return _no_trace
+
+
+# Packets are numbered as they're made, and the number picks their color
+_packet_serial = itertools.count()
+
+def _id_of (entity):
+  """ Returns an entity's ID, or -1 for NullAddress (or None). """
+  return getattr(entity, '_serial', -1)
+
+# Packet.__copy__() copies Packet's own slots itself.  This holds the
+# rest of the slots for each Packet subclass, and whether it has a __dict__.
+_extra_slots = {}
+
+def _slots_of (cls):
+  names = []
+  for c in cls.__mro__:
+    if c is Packet or c is object: continue
+    slots = c.__dict__.get('__slots__', ())
+    if isinstance(slots, basestring): slots = (slots,)
+    names.extend(n for n in slots if n not in ('__dict__', '__weakref__'))
+  r = _extra_slots[cls] = (names, cls.__dictoffset__ != 0)
+  return r
+
+
 class Packet (object):
+  # Packets have no __dict__ (which makes them much smaller), but
+  # subclasses without a __slots__ of their own get one as usual.
+  # src_id and dst_id are the entity IDs of src and dst (-1 for none), so
+  # a router can keep its tables in lists indexed by ID (see
+  # Entity.entity_id) instead of dicts keyed by entities.  They're set
+  # when the packet is made and when src is filled in on sending; if you
+  # change .src or .dst later, change them too.
+  __slots__ = ('src', 'dst', 'src_id', 'dst_id', 'ttl', 'trace',
+               '_color', '_outer_color', '_inner_color')
+
+  # Control packets (routing updates and such, as opposed to data) are
+  # counted separately to tell when the network has converged.
+  control = False
+
+  # The alpha of the outer color
+  _outer_alpha = .75
+
   def __init__ (self, dst=NullAddress, src=NullAddress):
 	 """
 	 Create a packet from src to dst.
@@ -62,14 +204,90 @@ class Packet (object):
 	 """
 	 self.src = src
 	 self.dst = dst
+	 self.src_id = _id_of(src)
+	 self.dst_id = _id_of(dst)
 	 self.ttl = 20   # TTL.  Decremented for each entity we go through.
-	 self.trace = [] # Trace of all entities we've been sent through.
+	 self.trace = _new_trace() # Trace of all entities we've been sent through.
+
+	 # When using NetVis, packets are visible, and you can set the color
+	 # (see outer_color and inner_color).  The colors are only made up
+	 # when something asks for them.
+	 self._color = next(_packet_serial)
+	 self._outer_color = None
+	 self._inner_color = None
+
+  @property
+  def outer_color (self):
+	 """
+	 The color of the outside of the packet in NetVis.
+	 A color is a list of red, green, blue, and (optionally) alpha values.
+	 Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
+	 """
+	 c = self._outer_color
+	 if c is None:
+		c = self._outer_color = self._default_outer_color()
+	 return c
+
+  @outer_color.setter
+  def outer_color (self, color):
+	 self._outer_color = color
+
+  @property
+  def inner_color (self):
+	 """ The color of the inside of the packet in NetVis. """
+	 c = self._inner_color
+	 if c is None:
+		c = self._inner_color = self._default_inner_color()
+	 return c
 
-	 # When using NetVis, packets are visible, and you can set the color.
-	 # color is a list of red, green, blue, and (optionally) alpha values.
-	 # Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
-	 self.outer_color = hsv_to_rgb(rand(), rand()*.25+.1, rand()*.95+.5,.75)
-	 self.inner_color = [0,0,0,0] # transparent
+  @inner_color.setter
+  def inner_color (self, color):
+	 self._inner_color = color
+
+  def _default_outer_color (self):
+	 # A hue (and so on) for each packet number, spread out by the golden
+	 # ratio so that packets made one after another look different.
+	 # Copies of a packet have the same number, so they look the same.
+	 n = self._color
+	 return hsv_to_rgb(n * .6180339887 % 1, n * .7548776662 % 1 * .25 + .1,
+							 n * .5698402910 % 1 * .95 + .5, self._outer_alpha)
+
+  def _default_inner_color (self):
+	 return [0,0,0,0] # transparent
+
+  def __copy__ (self):
+	 """
+	 Packets are copied (shallowly) for each port they're sent out of.
+	 This is just a faster version of what copy.copy() would do anyway.
+	 """
+	 cls = type(self)
+	 p = object.__new__(cls)
+	 p.src = self.src
+	 p.dst = self.dst
+	 p.src_id = self.src_id
+	 p.dst_id = self.dst_id
+	 p.ttl = self.ttl
+	 p.trace = self.trace
+	 p._color = self._color
+	 p._outer_color = self._outer_color
+	 p._inner_color = self._inner_color
+	 extra = _extra_slots.get(cls)
+	 if extra is None: extra = _slots_of(cls)
+	 names,has_dict = extra
+	 for name in names:
+		try:
+		  setattr(p, name, getattr(self, name))
+		except AttributeError:
+		  pass
+	 if has_dict: p.__dict__.update(self.__dict__)
+	 return p
+
+  def _sent (self):
+	 """
+	 You should never call this.  It's called by the framework once
+	 copies of this packet have been sent.
+	 """
+	 pass
 
   def mark (self, entity):
 	 """
@@ -84,11 +302,37 @@ class Packet (object):
 											self.dst.name if self.dst else None)
 
 
+_entity_serial = itertools.count()
+
 class Entity (object):
   """
   Base class for all entities (switches, hosts, etc.).
   """
 
+  # The TopoNode which connects this entity to the others (set when it's
+  # created with create())
+  _topo = None
+
+  def __new__ (cls, *args, **kw):
+	 self = object.__new__(cls)
+	 # Entities are numbered in the order they're made (see entity_id).
+	 # They hash by it instead of by address, so that iterating over a dict
+	 # keyed by entities goes the same way every run.
+	 self._serial = next(_entity_serial)
+	 return self
+
+  def __hash__ (self):
+	 return self._serial
+
+  @property
+  def entity_id (self):
+	 """
+	 This entity's ID, a small integer.  Entities are numbered from 0 in
+	 the order they're made, so a table about entities can be a list
+	 indexed by ID instead of a dict.
+	 """
+	 return self._serial
+
   @classmethod
   def create (cls, name, *args, **kw):
 	 """
@@ -100,10 +344,8 @@ class Entity (object):
   def get_port_count (self):
 	 """
 	 Returns the number of ports this entity has.
-	 This function may appear to be unimplemented, but it does
-	 in fact work.
 	 """
-	 pass
+	 return len(self._topo.ports)
 
   def handle_rx (self, packet, port):
 	 """
@@ -117,10 +359,9 @@ class Entity (object):
   def set_debug (self, *args):
 	 """
 	 Turns all arguments into a debug message for this Entity.
-	 This function may appear to be unimplemented, but it does
-	 in fact work.
 	 """
-	 pass
+	 core.world.do(core.events.set_debug, self.name,
+						' '.join((str(s) for s in args)))
 
   def log (self, msg, *args, **kwargs):
 	 """
@@ -135,11 +376,13 @@ class Entity (object):
 	 See the main simulator.py for some more info about configuring the
 	 logs.
 	 Note that you can also use api.userlog.debug(...) and friends directly.
-
-	 This function may appear to be unimplemented, but it does
-	 in fact work.
 	 """
-	 pass
+	 level = kwargs.pop("level", "debug").lower()
+	 if level not in ['debug', 'info', 'warning', 'error', 'critical', 'exception']:
+		level = "debug"
+	 func = getattr(userlog, level)
+	 msg = "%s:" + msg # Black magic
+	 func(msg, self.name, *args, **kwargs)
 
   def send (self, packet, port=None, flood=False):
 	 """
@@ -149,20 +392,31 @@ class Entity (object):
 	 port can be a numeric port number, or a list of port numbers.
 	 If flood is True, the meaning of port is reversed -- packets will
 	 be sent from all ports EXCEPT those listed.
-
-	 This function may appear to be unimplemented, but it does
-	 in fact work.
 	 """
-	 pass
+	 self._topo.send(packet, port, flood)
 
   def remove (self):
 	 """
 	 Removes this entity from existence.
+	 """
+	 self._topo.disconnect()
+	 core.world.do(core.events.send_entity_down, self.name)
+	 core.entities.remove(self.name)
 
-	 This function may appear to be unimplemented, but it does
-	 in fact work.
+  def linkTo (self, other, *args, **kw):
 	 """
-	 pass
+	 Links this entity to another one.  See sim.topo.link(), which is
+	 the usual way to do this.
+	 """
+	 return self._topo.linkTo(other, *args, **kw)
+
+  def unlinkTo (self, other):
+	 """ Takes down the links between this entity and another one. """
+	 return self._topo.unlinkTo(other)
+
+  def disconnect (self):
+	 """ Takes down all of this entity's links. """
+	 return self._topo.disconnect()
 
   def __repr__ (self):
 	 return "<" + self.__class__.__name__ + " " + str(self.name) + ">"
@@ -18,12 +18,11 @@ class BasicHost (HostEntity):
 		# Silently drop messages not to anyone in particular
 		return
 
-	 trace = ','.join((s.name for s in packet.trace))
-
+	 # The trace is only formatted if the message is actually logged
 	 if packet.dst is not self:
-		self.log("NOT FOR ME: %s %s" % (packet, trace), level="WARNING")
+		self.log("NOT FOR ME: %s %s", packet, packet.trace, level="WARNING")
 	 else:
-		self.log("rx: %s %s" % (packet, trace))
+		self.log("rx: %s %s", packet, packet.trace)
 		if type(packet) is Ping:
 		  # Trace this path
 		  import core
@@ -34,11 +33,16 @@ class BasicHost (HostEntity):
 
 class Ping (Packet):
   """ A Ping packet """
+  __slots__ = ('data',)
+
+  _outer_alpha = 1 # Full opacity
+
   def __init__ (self, dst, data=None):
 	 Packet.__init__(self, dst=dst)
 	 self.data = data
-	 self.outer_color[3] = 1 # Full opacity
-	 self.inner_color = [1,1,1,1] # white
+
+  def _default_inner_color (self):
+	 return [1,1,1,1] # white
 
   def __repr__ (self):
 	 d = self.data
@@ -54,13 +58,18 @@ class Pong (Packet):
   A Pong packet.  It's a returned Ping.  The original Ping is in
   the .original property.
   """
+  __slots__ = ('original',)
+
   def __init__ (self, original):
 	 Packet.__init__(self, dst=original.src)
 	 self.original = original
 
-	 # Flip colors from original
-	 self.outer_color = original.inner_color
-	 self.inner_color = original.outer_color
+  # Flip colors from original
+  def _default_outer_color (self):
+	 return self.original.inner_color
+
+  def _default_inner_color (self):
+	 return self.original.outer_color
 
   def __repr__ (self):
 	 return "<Pong " + str(self.original) + ">"
@@ -85,6 +94,10 @@ class DiscoveryPacket (Packet):
 	 A "link latency change" packet.
 	 latency should be float("inf") if the link is down.
 	 """
+	 __slots__ = ('latency', 'is_link_up')
+
+	 control = True
+
 	 def __init__(self, src, latency):
 		  Packet.__init__(self, src=src)
 		  self.latency = latency
@@ -101,28 +114,98 @@ class RoutingUpdate (Packet):
 	 """
 	 A Routing Update message to use with your RIPRouter implementation.
 	 """
+	 __slots__ = ('_paths', '_share', '_escaped', '_out')
+
+	 control = True
 
 	 def __init__(self):
 		  Packet.__init__(self)
-		  self.paths = {}
+		  self._paths = {}
+		  # The copies of an update that get sent out of each port all share
+		  # one paths dict until one of them goes to change it.  _share is a
+		  # list holding the number of updates sharing it (or None once this
+		  # update has been sent and the copies have it instead).
+		  self._share = [1]
+		  # Whether whoever made this update may have _paths too (it came from
+		  # or went out through .paths).  Then the copies that get sent can't
+		  # share it, since it could change under them; they share a snapshot
+		  # instead, which is kept as (dict, share) in _out while sending.
+		  self._escaped = False
+		  self._out = None
+
+	 @property
+	 def paths(self):
+		  """
+		  The dict of destination -> distance.  It's your own to change.
+		  """
+		  d = self._own()
+		  self._escaped = True
+		  return d
+
+	 @paths.setter
+	 def paths(self, paths):
+		  self._paths = paths
+		  self._share = [1]
+		  self._escaped = True
+		  self._out = None
+
+	 def _own(self):
+		  """ Makes sure no other update is sharing _paths. """
+		  self._out = None
+		  share = self._share
+		  if share is None or share[0] > 1:
+			 if share is not None: share[0] -= 1
+			 self._paths = dict(self._paths)
+			 self._share = [1]
+		  return self._paths
+
+	 def _view(self):
+		  """ Returns _paths for reading. """
+		  if self._share is None: return self._own()
+		  return self._paths
+
+	 def __copy__(self):
+		  if self._escaped:
+			 if self._out is None:
+				self._out = (dict(self._paths), [0])
+			 paths,share = self._out
+		  else:
+			 paths = self._view()
+			 share = self._share
+		  p = Packet.__copy__(self)
+		  p._paths = paths
+		  p._share = share
+		  p._escaped = False
+		  p._out = None
+		  share[0] += 1
+		  return p
+
+	 def _sent(self):
+		  if self._escaped:
+			 # The copies have their own snapshot; this one keeps its paths
+			 self._out = None
+		  elif self._share is not None:
+			 # The copies that went out hold the paths now
+			 self._share[0] -= 1
+			 self._share = None
 
 	 def add_destination(self, dest, distance):
 		  """
 		  Add a destination to announce, along with senders distance to that dest.
 		  """
-		  self.paths[dest] = distance
+		  self._own()[dest] = distance
 
 	 def get_distance(self, dest):
 		  """
 		  Get the distance to the specified destination.
 		  """
-		  return self.paths[dest]
+		  return self._view()[dest]
 
 	 def all_dests(self):
 		  """
 		  Get a list of all destinations with paths announced in this message.
 		  """
-		  return self.paths.keys()
+		  return self._view().keys()
 
 	 def str_routing_table(self):
-		  return str(self.paths) 
+		  return str(self._view()) 
@@ -1,6 +1,7 @@
-import random
 from core import world
 from core import events
+from core import rng
+from core import Delivery
 
 #default_latency = 0.5
 
@@ -47,14 +48,19 @@ class BasicCable (Cable):
       self.latency = default_latency
 
   def transfer (self, packet):
-    def rx ():
-      packet.mark(self.dstEnt) #FIXME: do this somewhere more convenient
-      self.dstEnt.handle_rx(packet, self.dstPort)
-
-    world.doLater(self.latency, rx)
+    self.launch(packet)
 
     events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
 
+  def launch (self, packet):
+    """ Puts packet on the wire, to be delivered after the latency. """
+    world.schedule(self.latency, Delivery(world, self, packet))
+
+  def deliver (self, packet):
+    """ Hands packet to the far end. """
+    packet.mark(self.dstEnt) #FIXME: do this somewhere more convenient
+    self.dstEnt.handle_rx(packet, self.dstPort)
+
 
 class UnreliableCable (BasicCable):
   """
@@ -78,8 +84,15 @@ class UnreliableCable (BasicCable):
     super(UnreliableCable, self).__init__(latency = latency)
     self.drop = drop
 
+  def initialize (self, src, srcport, dst, dstport):
+    super(UnreliableCable, self).initialize(src, srcport, dst, dstport)
+    # Each cable gets its own stream so its drops don't depend on
+    # what any other cable (or anything else) has drawn.
+    self.rng = rng("cable %s:%s->%s:%s" % (self.srcEnt.name, srcport,
+                                          self.dstEnt.name, dstport))
+
   def transfer (self, packet):
-    if random.random() >= self.drop:
+    if self.rng.random() >= self.drop:
       super(UnreliableCable, self).transfer(packet)
     else:
       events.packet(self.srcEnt.name, self.dstEnt.name, packet,
@@ -0,0 +1,226 @@
+"""
+Saves the whole state of a simulation to a file, and loads it back.
+
+Build a topology, let it converge, and save() it; later (in a fresh
+simulator, before it has been started) load() it and carry on from
+exactly where it was -- the entities and whatever they've learned, the
+links and cables between them, the packets in flight, the timers and the
+random streams all come back.  This makes it cheap to run lots of
+experiments from the same converged network:
+
+  import sim.checkpoint
+  sim.checkpoint.load("converged.sim")
+  s1.unlinkTo(s2)
+  sim.core.simulate()
+
+Everything is pickled, so whatever your entities keep (and whatever the
+pending events and timers call) has to be picklable.  Bound methods are
+fine; lambdas and other nested functions aren't.  The classes of the
+entities need to be importable from the same place when loading.
+
+Students should never need to touch this.
+"""
+
+import cPickle
+import copy_reg
+import itertools
+import time
+import types
+
+import api
+import core
+import cable
+
+VERSION = 2
+
+
+def save (filename):
+  """ Saves the state of the simulation to the file filename. """
+  world = core.world
+  paused = False
+  if world._thread is not None and not world.paused:
+    if world._is_world_thread():
+      # We're between events, so everything is consistent already
+      pass
+    else:
+      world.pause()
+      paused = True
+  try:
+    with open(filename, "wb") as f:
+      _save(f)
+  finally:
+    if paused:
+      world.resume()
+
+
+def load (filename):
+  """
+  Loads a simulation saved with save().
+  Do this in a fresh simulator: no entities can have been created yet,
+  and the world can't have been started.
+  """
+  with open(filename, "rb") as f:
+    _load(f)
+
+
+def _save (f):
+  world = core.world
+  # Only the entities which are still around (not remove()d)
+  nodes = sorted((te for te in core.topo.values()
+                  if core.entities.get(te.entity.name) is te.entity),
+                 key = lambda te: te.entity._serial)
+  entities = [te.entity for te in nodes]
+
+  now = world.now()
+  sweep = world.timers._sweep
+  events = [(t,h) for t,h in world.pending() if h.method != sweep]
+
+  streams = dict((name, r.getstate()) for name,r in core._streams.items())
+
+  # Entities are created (with their right hashes) before anything that
+  # refers to them is loaded, so the header says what they are
+  header = {
+    'version' : VERSION,
+    'now' : now,
+    'entities' : [(e.name, type(e), e._serial) for e in entities],
+    # (Removed entities' IDs aren't given out again)
+    'serial' : core.entities.id_limit(),
+    'seed' : core._seed,
+    'streams' : streams,
+  }
+  cPickle.dump(header, f, cPickle.HIGHEST_PROTOCOL)
+
+  body = {
+    'entities' : dict((e.name, e.__dict__) for e in entities),
+    'topo' : dict((te.entity.name, te.__dict__) for te in nodes),
+    'events' : events,
+    'timers' : world.timers.pending(),
+  }
+  ids = _persistent_ids(nodes)
+  p = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+  p.persistent_id = lambda obj: ids.get(id(obj))
+  p.dump(body)
+
+
+def _persistent_ids (nodes):
+  """
+  Returns a dict of id(object) -> persistent ID for the objects which
+  aren't pickled as part of the body, but refer to the same thing when
+  loaded.
+  """
+  world = core.world
+  ids = {}
+  ids[id(world)] = ('w',)
+  ids[id(world.timers)] = ('t',)
+  ids[id(core.events)] = ('v',)
+  ids[id(cable.events)] = ('v',)
+  ids[id(core.NullAddress)] = ('n',)
+  for te in nodes:
+    ids[id(te)] = ('te', te.entity.name)
+    ids[id(te.entity)] = ('e', te.entity.name)
+  return ids
+
+
+def _load (f):
+  world = core.world
+  if len(core.topo):
+    raise RuntimeError("Can't load a simulation once entities exist")
+  if world._started:
+    raise RuntimeError("Can't load a simulation once the world has started")
+
+  header = cPickle.load(f)
+  if header.get('version') != VERSION:
+    raise RuntimeError("Don't know how to load this version of checkpoint")
+
+  # Make the entities and their TopoNodes first (so that the entities
+  # have the right hashes before they go in any dicts) and fill them in
+  # once the rest has been loaded
+  entities = {}
+  nodes = {}
+  for name,kind,serial in header['entities']:
+    core.entities._check(name)
+    e = kind.__new__(kind)
+    e._serial = serial
+    e.name = name
+    te = core.TopoNode.__new__(core.TopoNode)
+    core._wire(e, te)
+    entities[name] = e
+    nodes[name] = te
+
+  def persistent_load (pid):
+    kind = pid[0]
+    if kind == 'e': return entities[pid[1]]
+    if kind == 'te': return nodes[pid[1]]
+    # (Older checkpoints refer to entities' methods this way)
+    if kind == 'f': return getattr(entities[pid[1]], pid[2])
+    if kind == 'w': return world
+    if kind == 't': return world.timers
+    if kind == 'v': return core.events
+    if kind == 'n': return core.NullAddress
+    raise cPickle.UnpicklingError("Unknown persistent ID " + repr(pid))
+
+  u = cPickle.Unpickler(f)
+  u.persistent_load = persistent_load
+  body = u.load()
+
+  # Set the clock to where it was
+  now = header['now']
+  if world.virtual:
+    world._now = now
+  else:
+    world._base = now
+    world._wall = time.time()
+
+  for name,kind,serial in header['entities']:
+    e = entities[name]
+    te = nodes[name]
+    e.__dict__.update(body['entities'][name])
+    te.__dict__.update(body['topo'][name])
+    core.entities.add(e)
+    core.topo[e] = te
+    kind = "host" if isinstance(e, api.HostEntity) else "switch"
+    world.do(core.events.send_entity_up, name, kind)
+  for te in nodes.values():
+    for n,c in enumerate(te.ports):
+      if c is None: continue
+      world.do(core.events.send_link_up, te.entity.name, n,
+               c.dst.entity.name, c.dstPort)
+
+  for t,h in body['events']:
+    h._queued = False
+    world._add(t, h)
+  for timer in body['timers']:
+    timer._queued = False
+    world.timers.add(timer, timer._deadline - now)
+
+  api._entity_serial = itertools.count(header['serial'])
+  core._seed = header['seed']
+  for name,state in header['streams'].items():
+    core.rng(name).setstate(state)
+
+
+# Methods pickle as their object, class and name.  They're looked up
+# through the class so that an instance attribute with the same name
+# doesn't get in the way.
+
+def _reduce_method (m):
+  if m.im_self is None or isinstance(m.im_self, type):
+    # Unbound, or a classmethod
+    return getattr, (m.im_self or m.im_class, m.im_func.__name__)
+  return _bind, (m.im_self, m.im_class, m.im_func.__name__)
+
+def _bind (obj, cls, name):
+  if not isinstance(obj, cls):
+    # Something that stands for whatever is there when loading (like the
+    # GUI interface) may not be the same kind of thing
+    cls = type(obj)
+  return getattr(cls, name).__get__(obj, cls)
+
+def _reduce_builtin (m):
+  if getattr(m, '__self__', None) is None or isinstance(m.__self__,
+                                                        types.ModuleType):
+    return m.__name__
+  return getattr, (m.__self__, m.__name__)
+
+copy_reg.pickle(types.MethodType, _reduce_method)
+copy_reg.pickle(types.BuiltinMethodType, _reduce_builtin)
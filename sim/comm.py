@@ -14,6 +14,10 @@ class NullInterface (object):
   def send_log (self, record):
     pass
   
+  def send_initialize (self):
+    """ Sends the whole topology at once """
+    pass
+
   def send_entity_down (self, name):
     pass
 
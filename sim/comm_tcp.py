@@ -5,8 +5,11 @@ log viewer and NetVis.
 
 import comm
 import socket
+import errno
 import json
+import sys
 import threading
+import traceback
 
 import core
 import api
@@ -15,33 +18,22 @@ class StreamingConnection (comm.NullInterface):
   def __init__ (self, parent, sock):
     self.sock = sock
     self.parent = parent
-    self.thread = threading.Thread(target = self._recvLoop)
-    self.thread.daemon = True
-    self.thread.start()
+    if parent.single_loop:
+      # No thread of our own; the world tells us when there's data
+      self._in = ''
+      self._retry = 0
+      self._out = []
+      self._out_lock = threading.Lock()
+      self._writing = False
+      self.thread = None
+      sock.setblocking(0)
+      core.world.add_reader(sock, self._readable)
+    else:
+      self.thread = threading.Thread(target = self._recvLoop)
+      self.thread.daemon = True
+      self.thread.start()
 
-    def make (a,A, b,B):
-      a = a.entity.name
-      b = b.entity.name
-      if a <= b:
-        return (a,A,b,B)
-      return (b,B,a,A)
-
-    links = set()
-    for te in core.topo.values():
-      for n,p in enumerate(te.ports):
-        if p is None: continue
-        links.add(make(te, n, p.dst, p.dstPort))
-    links = [list(e) for e in links]
-
-    msg = {
-      'type':'initialize',
-      'entities':dict([(n.entity.name,
-                   'circle' if isinstance(n.entity, api.HostEntity) else 'square')
-                  for n in core.topo.values()]),
-      #      'entities': {},
-      'links':links,
-    }
-    parent.send(msg, connections=self)
+    parent.send_initialize(connections=self)
 
   def _recvLoop (self):
     import select
@@ -70,54 +62,112 @@ class StreamingConnection (comm.NullInterface):
           #TODO: reopen
           break
         while d.find('\n') >= 0:
-            l,d = d.split('\n', 1)
-            l = l.strip()
-            if len(l) == 0: continue
-            methodName = "<UNSET>"
-            try:
-              data = json.loads(l)
-              methodName = "_handle_" + data.get('type', "<UNDEFINED>")
-              m = getattr(self, methodName)
-              del data['type']
-              world.doLater(0, m, **data)
-            except:
-              core.simlog.error("Error dispatching " + methodName)
-              traceback.print_exc()
+          l,d = d.split('\n', 1)
+          self._dispatch(l)
     core.events._disconnect(self)
 
+  def _readable (self):
+    """ Called by the world (in single loop mode) when there's data. """
+    try:
+      r = self.sock.recv(4096)
+    except socket.error as e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        return
+      r = None
+    if r == '':
+      self._retry += 1
+      if self._retry <= 4: return
+      r = None
+    if r is None:
+      core.events._disconnect(self)
+      return
+    self._retry = 0
+    self._in += r
+    while self._in.find('\n') >= 0:
+      l,self._in = self._in.split('\n', 1)
+      self._dispatch(l)
+
+  def _dispatch (self, l):
+    l = l.strip()
+    if len(l) == 0: return
+    methodName = "<UNSET>"
+    try:
+      data = json.loads(l)
+      kind = data.pop('type', "<UNDEFINED>")
+      methodName = "_control_" + kind
+      m = getattr(self, methodName, None)
+      if m is not None:
+        # Run control has to work while the world is paused, so
+        # it doesn't wait its turn in the world's queue
+        m(**data)
+        return
+      methodName = "_handle_" + kind
+      m = getattr(self, methodName)
+      if self.thread is None:
+        # We're already running in the world's thread
+        m(**data)
+      else:
+        core.world.doLater(0, m, **data)
+    except:
+      core.simlog.error("Error dispatching " + methodName)
+      traceback.print_exc()
+
   def _handle_ping (self, node1, node2):
       import basics
-      node1 = _getByName(node1).entity
-      node2 = _getByName(node2).entity
+      node1 = core._getByName(node1).entity
+      node2 = core._getByName(node2).entity
       if node1 and node2:
         node1.send(basics.Ping(node2), flood=True)
 
   def _handle_console (self, command):
       # Execute python command, return output to GUI
-      r = interp.runsource(command, "<gui>")
+      r = core.interp.runsource(command, "<gui>")
       if r:
         core.events.send_console_more(command)
 
   def _handle_addEdge (self, node1, node2):
-    node1 = _getByName(node1)
-    node2 = _getByName(node2)
+    node1 = core._getByName(node1)
+    node2 = core._getByName(node2)
     if node1 and node2:
       if not node1.isConnectedTo(node2):
         node1.linkTo(node2)
 
   def _handle_delEdge (self, node1, node2):
-    node1 = _getByName(node1)
-    node2 = _getByName(node2)
+    node1 = core._getByName(node1)
+    node2 = core._getByName(node2)
     if node1 and node2:
       if node1.isConnectedTo(node2):
         node1.unlinkTo(node2)
 
   def _handle_disconnect (self, node):
-    node = _getByName(node)
+    node = core._getByName(node)
     if node:
       node.disconnect()
 
+  def _control_pause (self):
+    core.world.pause()
+
+  def _control_resume (self):
+    core.world.resume()
+
+  def _control_step (self, count = 1):
+    core.world.step(count, wait=False)
+
+  def _control_run_until (self, time):
+    core.world.run_until(time, wait=False)
+
+  def _control_speed (self, factor):
+    core.world.set_speed(factor)
+
   def send_raw (self, msg):
+    if self.thread is None:
+      # Queue it up and let the world write it out when the socket's ready
+      with self._out_lock:
+        self._out.append(msg)
+        if self._writing: return
+        self._writing = True
+      core.world.add_writer(self.sock, self._writable)
+      return
     try:
       self.sock.send(msg)
     except:
@@ -129,18 +179,42 @@ class StreamingConnection (comm.NullInterface):
       #TODO: reopen?
       pass
 
+  def _writable (self):
+    with self._out_lock:
+      data = ''.join(self._out)
+      try:
+        n = self.sock.send(data)
+      except socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          # Give up on it; the reader will notice it's gone
+          data = ''
+        n = 0
+      data = data[n:]
+      self._out = [data] if data else []
+      if not data:
+        self._writing = False
+        core.world.remove_writer(self.sock)
+
 
 class StreamingInterface (object):
   def __init__ (self):
+    # If _SINGLE_LOOP is set in __main__, network I/O is done by the
+    # world's own thread instead of a thread per connection
+    main = sys.modules['__main__'].__dict__
+    self.single_loop = main.get("_SINGLE_LOOP", False)
+
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     self.sock.bind(("127.0.0.1", 4444))
     self.sock.listen(5)
-    self.thread = threading.Thread(target = self._listenLoop)
-    self.thread.daemon = True
-    self.thread.start()
-
     self.connections = []
+    if self.single_loop:
+      self.thread = None
+      core.world.add_reader(self.sock, self._accept)
+    else:
+      self.thread = threading.Thread(target = self._listenLoop)
+      self.thread.daemon = True
+      self.thread.start()
 
   def _listenLoop (self):
     import select
@@ -157,7 +231,14 @@ class StreamingInterface (object):
       pass
     core.simlog.debug("No longer listening for remote interfaces")
 
+  def _accept (self):
+    sock,addr = self.sock.accept()
+    self.connections.append(StreamingConnection(self, sock))
+
   def _disconnect (self, con):
+    if self.single_loop and con.sock is not None:
+      core.world.remove_reader(con.sock)
+      core.world.remove_writer(con.sock)
     try:
       con.sock.close()
     except:
@@ -173,6 +254,9 @@ class StreamingInterface (object):
       connections = self.connections
     elif not isinstance(connections, list):
       connections = [connections]
+    if not connections:
+      # Nobody's listening, so don't bother encoding it
+      return
     r = json.dumps(msg, default=repr) + "\n";
     bad = []
     for c in connections:
@@ -183,6 +267,32 @@ class StreamingInterface (object):
     for c in bad:
       self._disconnect(c)
 
+  def send_initialize (self, connections = None):
+    """ Sends the whole topology, which the GUI draws from scratch. """
+    def make (a,A, b,B):
+      a = a.entity.name
+      b = b.entity.name
+      if a <= b:
+        return (a,A,b,B)
+      return (b,B,a,A)
+
+    links = set()
+    for te in core.topo.values():
+      for n,p in enumerate(te.ports):
+        if p is None: continue
+        links.add(make(te, n, p.dst, p.dstPort))
+    links = [list(e) for e in links]
+
+    msg = {
+      'type':'initialize',
+      'entities':dict([(n.entity.name,
+                   'circle' if isinstance(n.entity, api.HostEntity) else 'square')
+                  for n in core.topo.values()]),
+      #      'entities': {},
+      'links':links,
+    }
+    self.send(msg, connections=connections)
+
   def send_console(self, text):
     #self.send({'type':'console','msg':text})
     pass
@@ -218,6 +328,9 @@ class StreamingInterface (object):
       })
 
   def packet (self, n1, n2, packet, duration, drop=False):
+    if not self.connections:
+      # (Which also saves making up colors for it)
+      return
     m = {
       "type":"packet",
       "node1":n1,
@@ -9,14 +9,27 @@ grading.
 import comm_tcp as interface
 #import comm_udp as interface
 #import comm as interface
+import comm
+import wheel
+import telemetry
 
 import sys
 import sim
 import copy
 import threading
-import Queue
+import thread
+import heapq
+import bisect
+import collections
 import time
 import weakref
+import os
+import select
+import socket
+import fcntl
+import random
+import hashlib
+import itertools
 
 import logging
 import traceback
@@ -93,21 +106,54 @@ class NullAddressType (object):
 
 NullAddress = NullAddressType()
 
+_seed = None
+_streams = {}
+
+def seed (value):
+  """
+  Seeds all of the simulator's random number streams.
+  Together with virtual time, this makes a run exactly reproducible.
+  Passing None goes back to unpredictable seeding.
+  """
+  global _seed
+  _seed = value
+  for name,stream in _streams.items():
+    stream.seed(_stream_seed(name))
+
+def rng (name):
+  """
+  Returns the random.Random stream with the given name.
+  Each subsystem (and each UnreliableCable) draws from its own stream, so
+  what one of them does never shifts the numbers another one sees.
+  """
+  r = _streams.get(name)
+  if r is None:
+    r = random.Random(_stream_seed(name))
+    _streams[name] = r
+  return r
+
+def _stream_seed (name):
+  if _seed is None: return None
+  return int(hashlib.md5("%s/%s" % (_seed, name)).hexdigest(), 16)
+
+
 class Timer (object):
   """ It's a timer.
   You should just create this with api.create_timer()."""
   def __init__ (self, seconds, target=None, args=(), kw={}, passSelf=False):
     self.seconds = seconds
-    world.doLater(seconds, self.timeout)
     self.func = target
     self.stopped = False
     self.args = list(args)
     self.kw = dict(kw)
     if passSelf:
       self.args = [self] + self.args
+    world.timers.add(self, seconds)
 
   def cancel (self):
+    if self.stopped: return
     self.stopped = True
+    world.timers.cancelled(self)
 
   def timer (self):
     if self.func:
@@ -117,8 +163,9 @@ class Timer (object):
     if self.stopped: return
     try:
       rv = self.timer()
-      if rv is not False:
-        world.doLater(self.seconds, self.timeout)
+      # It may have been cancelled by its own callback
+      if rv is not False and not self.stopped:
+        world.timers.rearm(self)
     except:
       simlog.error("Exception while executing a timer")
       traceback.print_exc()
@@ -135,87 +182,738 @@ class OneShot (Timer):
       pass
 
 
+class EventHandle (object):
+  """
+  Returned by World.doLater() and friends.
+  Call .cancel() on it to withdraw the event.
+  """
+  # There can be a lot of these around, so they're kept small.  kw is None
+  # rather than an empty dict when there are no keyword arguments.
+  __slots__ = ('world', 'method', 'args', 'kw', '_queued')
+
+  # Background events (like the timer wheel's sweeps) don't keep the
+  # world from being quiet
+  background = False
+
+  def __init__ (self, world, method, args, kw):
+    self.world = world
+    self.method = method
+    self.args = args
+    self.kw = kw
+    # True while the event is in the world's heap
+    self._queued = False
+
+  @property
+  def cancelled (self):
+    return self.method is None
+
+  def fire (self):
+    """ Makes the event happen. """
+    if self.kw:
+      self.method(*self.args, **self.kw)
+    else:
+      self.method(*self.args)
+
+  def cancel (self):
+    """
+    Cancels the event if it hasn't happened yet.
+    The entry just stays in the schedule as dead weight until the world
+    gets to it (or compacts the schedule), so this is O(1).
+    """
+    if self.method is None: return
+    self.method = None
+    self.args = self.kw = None
+    self.world._cancelled(self)
+
+
+class Delivery (EventHandle):
+  """
+  The event of a cable delivering a packet to its far end.
+  These are by far the most common events, so rather than a bound method
+  and argument tuple, it just holds the cable and the packet.
+  """
+  __slots__ = ('cable', 'packet')
+
+  def __init__ (self, world, cable, packet):
+    self.world = world
+    # This is the cable's (unbound) deliver function.  It's never called
+    # through here, but it marks the event as live like for any other.
+    self.method = _deliver_function(type(cable))
+    self.args = self.kw = None
+    self._queued = False
+    self.cable = cable
+    self.packet = packet
+
+  def fire (self):
+    self.cable.deliver(self.packet)
+
+  def cancel (self):
+    EventHandle.cancel(self)
+    self.cable = self.packet = None
+
+  # The deliver function can't be pickled by name, so it's looked up again
+  def __getstate__ (self):
+    return (self.world, self.cable, self.packet, self._queued)
+
+  def __setstate__ (self, state):
+    world,cable,packet,queued = state
+    self.__init__(world, cable, packet)
+    self._queued = queued
+
+class BackgroundEvent (EventHandle):
+  """ An event that doesn't count as activity (see World.on_quiet()). """
+  __slots__ = ()
+  background = True
+
+_deliver_functions = {}
+
+def _deliver_function (kind):
+  f = _deliver_functions.get(kind)
+  if f is None:
+    f = _deliver_functions[kind] = kind.deliver.im_func
+  return f
+
+
 class World (object):
   """ Mostly this dispatches events in the simulator. """
-  def __init__ (self):
-    self.queue = Queue.PriorityQueue()
+  def __init__ (self, virtual = False):
+    # The schedule is a single heap of (time, count, EventHandle).
+    # count breaks ties so that events at the same time happen in the
+    # order they were scheduled.  Everything the world thread schedules
+    # is therefore in a deterministic order; only events injected from
+    # other threads (the GUI, the console) depend on timing.
+    self._heap = []
+    self._lock = threading.Condition(threading.Lock())
     self._thread = None
+    self._ident = None
     self._count = 0
 
+    # Cancelled events still in the heap.  When they make up more than
+    # compact_fraction of it, the heap is rebuilt without them.
+    self._dead = 0
+    self.compact_fraction = 0.5
+
+    # When the world thread is asleep, this is the time it's sleeping until
+    # (infinity if it's waiting for something to be scheduled).  It's None
+    # while the world is busy or paused, in which case there's no need to
+    # wake it.
+    self._sleeping = None
+
+    # Events scheduled by other threads (the GUI, the console) while the
+    # world is running go in this inbox as (time, EventHandle), and the
+    # world thread moves them into the heap in batches.  deque.append()
+    # and popleft() are atomic, so other threads never need the lock
+    # unless the world is asleep and has to be woken up.
+    self._inbox = collections.deque()
+
+    # In virtual time mode, the clock doesn't follow the wall clock at all.
+    # Instead, it jumps straight to the timestamp of the next event, so
+    # a headless run goes as fast as events can be processed.
+    self.virtual = virtual
+    self._now = 0.0
+    self._last = None
+
+    # In real time, the clock runs at _speed times the wall clock.  It
+    # read _base when the wall clock read _wall.
+    self._speed = 1.0
+    self._base = self._wall = time.time()
+
+    # Run control.  Nothing is dispatched while paused (and the clock
+    # stands still).  When set, _until (a time or a callable) and _steps
+    # pause the world again once it has gotten that far.
+    self._paused = False
+    self._until = None
+    self._steps = None
+    self._halted = threading.Event()
+    self._until_quiet = None
+    # While one thread runs the world inline (see run_until()), another
+    # (like the GUI's) can still pause it or step it.  _held_goal keeps the
+    # inline run's own condition while another's is carried out, and _held
+    # keeps the inline run waiting, rather than returning, while paused
+    # by someone else.
+    self._held_goal = None
+    self._held = False
+
+    # Quiescence.  _pending counts the events in the heap which aren't in
+    # the background, and _control the control packets (see
+    # api.Packet.control) that are in flight.  When either drops to zero,
+    # the world has gone quiet (or control quiet): the time is recorded,
+    # listeners are called, and the matching Event is set.
+    self._pending = 0
+    self._control = 0
+    self._busy = False
+    self._control_busy = False
+    self.quiet_time = None
+    self.control_quiet_time = None
+    self._quiet = threading.Event()
+    self._control_quiet = threading.Event()
+    self._quiet.set()
+    self._control_quiet.set()
+    self._quiet_listeners = []
+
     # When the world isn't running, items are put in the prelist.
     # They're added to the queue when the world is started, and
     # their start times are adjusted so that they are relative to
     # when the world was started, NOT to when they were added.
     self._prelist = []
+    self._started = False
+
+    # Timers live in their own wheel rather than in the heap
+    self.timers = wheel.TimerWheel(self)
+
+    # Statistics about what the world is up to
+    self.telemetry = telemetry.Telemetry(self)
+
+    # Sockets (or anything with a fileno()) the world watches itself,
+    # mapped to the callbacks to run when they're readable/writable.  When
+    # there are any, the world sleeps in select() instead of on _lock, and
+    # other threads wake it through the _wakeup pipe.
+    self._readers = {}
+    self._writers = {}
+    self._wakeup = None
+    self._next_poll = 0
+
+  def now (self):
+    """ Returns the current simulation time. """
+    if self.virtual:
+      return self._now
+    if self._paused:
+      return self._base
+    return self._base + (time.time() - self._wall) * self._speed
+
+  @property
+  def paused (self):
+    return self._paused
+
+  def next_event_time (self):
+    """ Returns the time of the next scheduled event (or None). """
+    with self._lock:
+      self._drain()
+      self._drop_dead_head()
+      return self._heap[0][0] if self._heap else None
+
+  def _drop_dead_head (self):
+    heap = self._heap
+    while heap and heap[0][2].method is None:
+      heapq.heappop(heap)[2]._queued = False
+      self._dead -= 1
+
+  def add_reader (self, sock, callback):
+    """
+    Has the world call callback() whenever sock is readable.
+    This lets network I/O share the world's thread instead of needing
+    threads of its own.
+    """
+    self._watch(self._readers, sock, callback)
+
+  def remove_reader (self, sock):
+    self._watch(self._readers, sock, None)
+
+  def add_writer (self, sock, callback):
+    """ Has the world call callback() whenever sock is writable. """
+    self._watch(self._writers, sock, callback)
+
+  def remove_writer (self, sock):
+    self._watch(self._writers, sock, None)
+
+  def _watch (self, watched, sock, callback):
+    with self._lock:
+      if self._wakeup is None:
+        r,w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFL, os.O_NONBLOCK)
+        self._wakeup = (r,w)
+      if callback is not None:
+        watched[sock] = callback
+      elif sock in watched:
+        del watched[sock]
+      self._wake()
+
+  def _wake (self):
+    """ Wakes up the world thread.  Call with the lock held. """
+    self._lock.notify()
+    if self._wakeup is not None:
+      try:
+        os.write(self._wakeup[1], 'x')
+      except OSError:
+        # The pipe is full, so it'll wake up anyway
+        pass
 
-  def _real_doLater (_self, _seconds, _method, *_args, **_kw):
-    t = time.time() + _seconds
-    _self.queue.put((t, _self._count, _method, _args, _kw))
-    _self._count += 1
+  def _poll (self, timeout):
+    """
+    Waits up to timeout seconds (forever if None) for any of the watched
+    sockets, and runs the callbacks for those that are ready.
+    Call with the lock held; it's released while waiting and running
+    the callbacks.
+    """
+    readers = self._readers.items()
+    writers = self._writers.items()
+    wakeup = self._wakeup[0]
+    self._lock.release()
+    try:
+      try:
+        rx,tx,xx = select.select([s for s,c in readers] + [wakeup],
+                                 [s for s,c in writers], [], timeout)
+      except (select.error, socket.error):
+        # Probably a socket that got closed out from under us
+        rx,tx = [],[]
+      if wakeup in rx:
+        os.read(wakeup, 4096)
+      for watched,ready in ((readers, rx), (writers, tx)):
+        for sock,callback in watched:
+          if sock in ready:
+            try:
+              callback()
+            except:
+              simlog.exception("Exception while handling %s", sock)
+    finally:
+      self._lock.acquire()
+      self._next_poll = time.time() + 0.01
+
+  def _is_world_thread (self):
+    return thread.get_ident() == self._ident
+
+  def _push (self, when, handle):
+    ident = self._ident
+    if ident is not None and ident != thread.get_ident():
+      # Another thread; leave it in the inbox
+      self._inbox.append((when, handle))
+      sleeping = self._sleeping
+      if sleeping is not None and when < sleeping:
+        with self._lock:
+          self._wake()
+      return handle
+    with self._lock:
+      self._enqueue(when, handle)
+    return handle
+
+  def _drain (self):
+    """ Moves everything in the inbox to the heap.  Call with the lock. """
+    inbox = self._inbox
+    while inbox:
+      when,handle = inbox.popleft()
+      if handle.method is not None:
+        self._enqueue(when, handle)
+
+  def _enqueue (self, when, handle):
+    """ Puts an event in the heap.  Call with the lock. """
+    handle._queued = True
+    heapq.heappush(self._heap, (when, self._count, handle))
+    self._count += 1
+    if not handle.background:
+      self._pending += 1
+      if not self._busy:
+        self._busy = True
+        self._quiet.clear()
+      if type(handle) is Delivery and handle.packet.control:
+        self._control += 1
+        if not self._control_busy:
+          self._control_busy = True
+          self._control_quiet.clear()
+    if self._sleeping is not None and when < self._sleeping:
+      # It's asleep and this is now the first thing to do
+      self._wake()
+
+  def _retire (self, handle):
+    """ Accounts for a live event leaving the heap.  Call with the lock. """
+    if not handle.background:
+      self._pending -= 1
+      if type(handle) is Delivery and handle.packet.control:
+        self._control -= 1
+
+  def _cancelled (self, handle):
+    with self._lock:
+      if not handle._queued: return
+      self._retire(handle)
+      self._dead += 1
+      heap = self._heap
+      if self._dead > 64 and self._dead > len(heap) * self.compact_fraction:
+        heap[:] = [o for o in heap if o[2].method is not None]
+        heapq.heapify(heap)
+        self._dead = 0
+
+  def _flush_prelist (self):
+    if self._started: return
+    self._started = True
+    for seconds,handle in self._prelist:
+      if handle.method is not None:
+        self._push(self.now() + seconds, handle)
+    self._prelist = []
 
   def start (self):
+    """
+    Runs the world in its own thread.
+    It runs freely from here even if it was left paused by running it
+    inline with run_until(), step() or run_until_quiet() (or by pause()),
+    so a network can be set up headless and then handed to NetVis.
+    Call pause() after start() to have it wait.
+    """
     assert self._thread is None
 
-    for a,b,c,d in self._prelist:
-      self._real_doLater(a, b, *c, **d)
-    self._prelist = []
+    self._flush_prelist()
+    with self._lock:
+      self._until = None
+      self._steps = None
+      self._until_quiet = None
+      self._held_goal = None
+      self._held = False
+      self._resume()
 
     self._thread = threading.Thread(target=self.run)
     self._thread.daemon = True
     self._thread.start()
 
   def do (self, _method, *args, **kw):
-    self.doLater(0, _method, *args, **kw)
+    return self.doLater(0, _method, *args, **kw)
 
   def doLater (_self, _seconds, _method, *_args, **_kw):
-    if _self._thread is not None:
-      _self._real_doLater(_seconds, _method, *_args, **_kw)
-    else:
-      _self._prelist.append((_seconds, _method, _args, _kw))
+    """
+    Calls _method with the given arguments in _seconds seconds.
+    Returns an EventHandle which can be used to cancel it.
+    """
+    return _self.schedule(_seconds,
+                          EventHandle(_self, _method, _args, _kw or None))
 
-  def run (self):
-    timeout = None
-    waiting = Queue.PriorityQueue()
+  def doAt (_self, _when, _method, *_args, **_kw):
+    """ Like doLater(), but _when is an absolute simulation time. """
+    return _self._add(_when, EventHandle(_self, _method, _args, _kw or None))
 
-    while True:
+  def schedule (self, seconds, handle):
+    """
+    Schedules an event (an EventHandle, such as a Delivery) to fire in
+    seconds seconds.  Returns it.
+    """
+    if self._started:
+      return self._push(self.now() + seconds, handle)
+    self._prelist.append((seconds, handle))
+    return handle
+
+  def _add (self, when, handle):
+    """ Schedules an existing EventHandle for the absolute time when. """
+    if self._started:
+      return self._push(when, handle)
+    self._prelist.append((when - self.now(), handle))
+    return handle
+
+  def pending (self):
+    """
+    Returns the events which are yet to happen as a list of
+    (time, EventHandle), in the order they'll happen.
+    """
+    with self._lock:
+      self._drain()
+      if self._started:
+        heap = sorted(o for o in self._heap if o[2].method is not None)
+        return [(t,h) for t,c,h in heap]
+      now = self.now()
+      # sorted() is stable, so ties stay in the order they were added
+      return sorted(((now + s, h) for s,h in self._prelist
+                     if h.method is not None), key = lambda o: o[0])
+
+  def run_until (self, until, wait = True):
+    """
+    Runs the world until the simulation time reaches until, or -- if
+    until is callable -- until it returns True (it's checked after every
+    event).  In virtual time, it also stops if it runs out of events.
+
+    If the world has been start()ed, this resumes it, blocks until the
+    condition holds (unless wait is False), and leaves it paused.  Called
+    from the world thread itself (e.g., by a GUI command), it just sets
+    things up and returns.  If the world hasn't been started, it runs
+    right here in the calling thread -- unless another thread is already
+    running it that way.  Then that thread carries this out just as the
+    world's own thread would, and afterwards waits for resume() to carry
+    on with its own run.
+    """
+    if callable(until) and until(): return
+    self._run_controlled(until, None, wait)
+
+  def step (self, count = 1, wait = True):
+    """ Runs the next count events and then pauses.  See run_until(). """
+    self._run_controlled(None, count, wait)
+
+  def run_until_quiet (self, limit = None, control_only = False,
+                       wait = True):
+    """
+    Runs the world until it goes quiet (see on_quiet()), or until the time
+    limit, and leaves it paused like run_until().
+    With control_only, it also stops when no control packets are left in
+    flight -- but only once that happens after the call (or once nothing
+    at all is left), since pending events may still send some.
+    Returns the time it went quiet, or None if it didn't.
+    """
+    if self._thread is None:
+      # Things which were scheduled before starting count too
+      self._flush_prelist()
+    done = threading.Event()
+    with self._lock:
+      if self._quiet.is_set():
+        done.set()
+    if not done.is_set():
+      self._run_controlled(float("inf") if limit is None else limit, None,
+                           wait, (done, control_only))
+    if not done.is_set(): return None
+    if control_only:
+      return max(self.control_quiet_time, self.quiet_time)
+    return self.quiet_time
+
+  def wait_quiet (self, timeout = None, control_only = False):
+    """
+    Waits (up to timeout seconds of wall time) for the world to go quiet
+    while it runs in its own thread.
+    Returns the time it went quiet, or None if it didn't.
+    """
+    quiet = self._control_quiet if control_only else self._quiet
+    if not quiet.wait(timeout): return None
+    return self.control_quiet_time if control_only else self.quiet_time
+
+  def on_quiet (self, callback, control_only = False):
+    """
+    Calls callback(time) (in the world thread) whenever the world goes
+    quiet -- that is, when nothing is left to happen except timers.  The
+    network has converged at that point, unless a timer stirs it up again.
+    With control_only, it's called when no control packets (like routing
+    updates) are left in flight instead, even if other packets are.
+    """
+    self._quiet_listeners.append((callback, control_only))
+
+  def _went_quiet (self):
+    """ Called after a batch of events if the world may have gone quiet. """
+    fire = []
+    with self._lock:
+      if self._busy and not self._pending:
+        self._busy = False
+        self.quiet_time = self._last
+        self._quiet.set()
+        fire.append(False)
+      if self._control_busy and not self._control:
+        self._control_busy = False
+        self.control_quiet_time = self._last
+        self._control_quiet.set()
+        fire.append(True)
+      if self._until_quiet is not None:
+        done,control_only = self._until_quiet
+        if False in fire or (control_only and True in fire):
+          done.set()
+          self._halt()
+    for callback,control_only in self._quiet_listeners:
+      if control_only in fire:
+        callback(self.control_quiet_time if control_only
+                 else self.quiet_time)
+
+  def pause (self):
+    """ Stops dispatching events (and stops the clock) until resume(). """
+    with self._lock:
+      if self._inline_elsewhere():
+        self._held = True
+      self._pause()
+      self._wake()
+
+  def resume (self):
+    """
+    Resumes running freely after pause(), run_until(), or step().
+    If another thread is running the world inline, it carries on with
+    that run instead.
+    """
+    with self._lock:
+      if self._held_goal is not None:
+        self._until,self._steps,self._until_quiet = self._held_goal
+        self._held_goal = None
+      elif not self._held:
+        self._until = None
+        self._steps = None
+        self._until_quiet = None
+      self._held = False
+      self._resume()
+
+  def set_speed (self, factor):
+    """
+    Makes the clock run factor times as fast as the wall clock.
+    Only affects real time mode; virtual time is as fast as it gets.
+    """
+    with self._lock:
+      if not self._paused:
+        self._base = self.now()
+        self._wall = time.time()
+      self._speed = float(factor)
+      self._wake()
+
+  def _pause (self):
+    if not self._paused:
+      self._base = self.now()
+      self._paused = True
+
+  def _resume (self):
+    if self._paused:
+      self._wall = time.time()
+      self._paused = False
+    self._wake()
+
+  def _halt (self):
+    """ Pauses because the run_until()/step() condition was met. """
+    self._pause()
+    if self._held_goal is not None:
+      # Done with what another thread asked for in the middle of an
+      # inline run, which waits to carry on until resume()
+      self._until,self._steps,self._until_quiet = self._held_goal
+      self._held_goal = None
+      self._held = True
+    else:
+      self._until = None
+      self._steps = None
+      self._until_quiet = None
+    self._halted.set()
+
+  def _inline_elsewhere (self):
+    """ Returns whether some other thread is running the world inline. """
+    return (self._thread is None and self._ident is not None
+            and not self._is_world_thread())
+
+  def _run_controlled (self, until, steps, wait, until_quiet = None):
+    with self._lock:
+      # Only run it here if nobody else is running it
+      inline = self._thread is None and self._ident is None
+      if self._inline_elsewhere() and self._held_goal is None:
+        self._held_goal = (self._until, self._steps, self._until_quiet)
+      self._until = until
+      self._steps = steps
+      self._until_quiet = until_quiet
+      self._halted.clear()
+      if inline:
+        self._held = False
+      self._resume()
+    if self._is_world_thread():
+      # Can't wait for ourself
+      return
+    if inline:
+      self._flush_prelist()
+      self._ident = thread.get_ident()
       try:
-        t = time.time()
-        while not waiting.empty():
-          o = waiting.get()
-          if o[0] <= t:
-            self.queue.put(o)
-            timeout = None
+        self._run()
+      finally:
+        self._ident = None
+    elif wait:
+      self._halted.wait()
+
+  def _next_batch (self):
+    """
+    Waits until something is due and then pops everything that is.
+    In virtual time, "due" means everything scheduled for the earliest
+    time in the heap, and the clock jumps to that time.  While a step()
+    or a run_until() with a condition is in progress, it's just one event
+    at a time.
+    Returns None if the world is paused and isn't running in its own
+    thread (so there's nothing to wait for).
+    """
+    heap = self._heap
+    inf = float("inf")
+    watching = False
+    with self._lock:
+      while True:
+        if self._inbox: self._drain()
+        watching = self._readers or self._writers
+        if watching and time.time() >= self._next_poll:
+          # Keep up with the sockets even while there's a lot to do
+          self._poll(0)
+
+        # Don't let a dead event set the clock
+        self._drop_dead_head()
+        due = None
+        if self._paused:
+          # An inline run is over unless someone else paused it
+          if self._thread is None and not self._held: return None
+        else:
+          limit = self._until
+          if limit is None or callable(limit): limit = inf
+          if self.virtual:
+            if heap and heap[0][0] <= limit:
+              now = heap[0][0]
+              if now > self._now:
+                self._now = now
+              break
+            if limit < inf and limit > self._now:
+              self._now = limit
+            if (self._thread is None or self._until is not None
+                or self._steps is not None):
+              # Nothing left that can happen in time
+              self._halt()
+              continue
+            due = inf
           else:
-            waiting.put(o)
-            o = waiting.get()
-            waiting.put(o)
-            timeout = o[0] - t
-            break
-        #print "World waiting for",timeout
-
-        o = self.queue.get(True, timeout)
-      except:
-        #print "empty"
-        continue
-
-      t = time.time()
-      if o[0] > t:
-        # Hasn't expired yet...
-        #print "recycle"
-        waiting.put(o)
-        o = waiting.get()
-        waiting.put(o)
-        timeout = o[0] - t
-        continue
-      # Expired
-      timeout = None
-      if False:
-        if hasattr(o[2], "im_self"):
-          print o[2].im_self.__class__.__name__ + "." + o[2].im_func.__name__,
+            now = self.now()
+            if heap and heap[0][0] <= min(now, limit): break
+            if now >= limit:
+              self._halt()
+              continue
+            due = min(heap[0][0] if heap else inf, limit)
+        self._sleeping = due
+        if self._inbox:
+          # Something came in after all (see _push())
+          self._sleeping = None
+          continue
+        timeout = None
+        if due is not None and due < inf:
+          timeout = max(0, (due - now) / self._speed)
+        if watching:
+          self._poll(timeout)
         else:
-          print o[2],
-        print o[3],o[4] if len(o[4]) else ''
-      o[2](*o[3],**o[4])
+          self._lock.wait(timeout)
+        self._sleeping = None
+
+      # The time of the latest batch of events
+      self._last = now
+
+      if self._steps is not None or callable(self._until):
+        h = heapq.heappop(heap)[2]
+        h._queued = False
+        self._retire(h)
+        return [h]
+
+      if self._until is not None: now = self._last = min(now, self._until)
+      if not self.virtual and self.telemetry.enabled:
+        self.telemetry.lag(now - heap[0][0])
+      batch = []
+      while heap and heap[0][0] <= now:
+        h = heapq.heappop(heap)[2]
+        h._queued = False
+        if h.method is None:
+          self._dead -= 1
+          continue
+        self._retire(h)
+        batch.append(h)
+      return batch
+
+  def _run (self):
+    while True:
+      batch = self._next_batch()
+      if batch is None: return
+      if self.telemetry.enabled:
+        self.telemetry.count(batch)
+      for h in batch:
+        if h.method is None:
+          # Cancelled by something earlier in the batch
+          continue
+        h.fire()
+
+      if ((self._busy and not self._pending)
+          or (self._control_busy and not self._control)):
+        self._went_quiet()
+
+      if self._steps is not None:
+        with self._lock:
+          if self._steps is not None:
+            self._steps -= 1
+            if self._steps <= 0:
+              self._halt()
+      elif callable(self._until):
+        until = self._until
+        if until():
+          with self._lock:
+            if self._until is until:
+              self._halt()
+
+  def run (self):
+    self._ident = thread.get_ident()
+    self._run()
 
 
 class TopoNode (object):
@@ -238,7 +936,23 @@ class TopoNode (object):
   def __init__ (self, numPorts = 0, growPorts =  True):
     self.ports = [None] * numPorts
     self.growPorts = growPorts
+    # A heap of the numbers of the empty ports, so linkTo() can find the
+    # lowest one without searching
+    self._free = range(numPorts)
     self.entity = None
+    # The numbers of the ports that have cables, in order (None when the
+    # ports have changed and it needs figuring out again).  Anything that
+    # changes .ports should call _portsChanged().
+    self._live = None
+    # Neighboring TopoNode -> the numbers of the ports (in order) with
+    # cables leading to it
+    self._neighbors = {}
+    # Port number -> EventHandle for links that are about to go down
+    self._going_down = {}
+    # A shadow is a copy of an entity that really runs in some other
+    # process (see sim.parallel).  It never sends anything, and isn't
+    # told about links going down.
+    self.shadow = False
 
   def linkTo (self, topoEntity, cable = None, fillEmpty = True, latency = None):
     """
@@ -254,6 +968,20 @@ class TopoNode (object):
       and
      a.linkTo(b, (C, D))
     """
+    topoEntity = topoOf(topoEntity)
+    localPort,remotePort = self._connect(topoEntity, cable, fillEmpty, latency)
+    self._discover(topoEntity, localPort, remotePort)
+
+    world.doLater(.5, events.send_link_up, self.entity.name, localPort,
+             topoEntity.entity.name, remotePort)
+
+    return (localPort, remotePort)
+
+  def _connect (self, topoEntity, cable, fillEmpty, latency):
+    """
+    Does the work of linkTo() without telling anyone about it.
+    Returns (localPort, remotePort).
+    """
     from cable import Cable, BasicCable
     if cable is None:
       cable = (BasicCable, BasicCable)
@@ -275,13 +1003,12 @@ class TopoNode (object):
       c.initialize(le, lp, re, rp)
       return c
 
-    topoEntity = topoOf(topoEntity)
     def getPort (entity):
-      if not fillEmpty or entity.ports.count(None) == 0:
+      if not fillEmpty or not entity._free:
         assert self.growPorts
         entity.ports.append(None)
         return len(entity.ports) - 1
-      return entity.ports.index(None)
+      return heapq.heappop(entity._free)
 
     assert topoEntity is not self
 
@@ -291,63 +1018,103 @@ class TopoNode (object):
     if cable[0] is not None:
       c = fixCableEnd(cable[0], self, localPort, topoEntity, remotePort)
       self.ports[localPort] = c
+      self._portsChanged()
+      bisect.insort(self._neighbors.setdefault(topoEntity, []), localPort)
 
+    if cable[1] is not None:
+      c = fixCableEnd(cable[1], topoEntity, remotePort, self, localPort)
+      topoEntity.ports[remotePort] = c
+      topoEntity._portsChanged()
+      bisect.insort(topoEntity._neighbors.setdefault(self, []), remotePort)
+
+    # A port that didn't get a cable after all is still free
+    if cable[0] is None:
+      heapq.heappush(self._free, localPort)
+    if cable[1] is None:
+      heapq.heappush(topoEntity._free, remotePort)
+
+    return (localPort, remotePort)
+
+  def _discover (self, topoEntity, localPort, remotePort):
+    """ Sends DiscoveryPackets both ways over a new link. """
+    from cable import BasicCable
+    c = self.ports[localPort]
+    if c is not None:
       #self.send(sim.basics.DiscoveryPacket(self.entity, True), localPort)
-      
+
       # Get latency if c is BasicCable - Kaifei Chen(kaifei@berkeley.edu)
       l = c.latency if isinstance(c, BasicCable) else None  # latency
       self.send(sim.basics.DiscoveryPacket(self.entity, latency=l), localPort)
 
-    if cable[1] is not None:
-      c = fixCableEnd(cable[1], topoEntity, remotePort, self, localPort)
-      topoEntity.ports[remotePort] = c
-
+    c = topoEntity.ports[remotePort]
+    if c is not None:
       #topoEntity.send(sim.basics.DiscoveryPacket(topoEntity.entity, True), remotePort)
 
       # Get latency if c is BasicCable - Kaifei Chen(kaifei@berkeley.edu)
       l = c.latency if isinstance(c, BasicCable) else None  # latency
       topoEntity.send(sim.basics.DiscoveryPacket(topoEntity.entity, latency=l), remotePort)
 
-    world.doLater(.5, events.send_link_up, self.entity.name, localPort,
-             topoEntity.entity.name, remotePort)
-
-    return (localPort, remotePort)
-
   def unlinkTo (self, topoEntity):
     topoEntity = topoOf(topoEntity)
-    def goDown (index):
-      port = self.ports[index]
-      if port is None: return
-      other = port.dst
-      otherPort = port.dstPort
-      events.send_link_down(self.entity.name, index, other.entity.name, otherPort)
-      
-      #topoEntity.entity.handle_rx(sim.basics.DiscoveryPacket(self.entity, False), otherPort)
-      #self.entity.handle_rx(sim.basics.DiscoveryPacket(topoEntity.entity, False), index)
-      
-      # Assign infinity to latency - Kaifei Chen(kaifei@berkeley.edu)
-      topoEntity.entity.handle_rx(sim.basics.DiscoveryPacket(self.entity, latency=float("inf")), otherPort)
-      self.entity.handle_rx(sim.basics.DiscoveryPacket(topoEntity.entity, latency=float("inf")), index)
-
-      other.ports[otherPort] = None
-      self.ports[index] = None
-
-    remove = [index for index,value in enumerate(self.ports)
-              if value is not None and value.dst is topoEntity]
+    remove = [index for index in self._neighbors.get(topoEntity, ())
+              if index not in self._going_down]
     for index in remove:
-      world.doLater(0.5, goDown, index)
+      self._going_down[index] = world.doLater(0.5, self._goDown, index)
+
+  def _goDown (self, index):
+    # This is a method rather than a closure so that a pending one can
+    # be checkpointed (see sim.checkpoint)
+    del self._going_down[index]
+    port = self.ports[index]
+    if port is None: return
+    other = port.dst
+    otherPort = port.dstPort
+    events.send_link_down(self.entity.name, index, other.entity.name, otherPort)
+
+    #other.entity.handle_rx(sim.basics.DiscoveryPacket(self.entity, False), otherPort)
+    #self.entity.handle_rx(sim.basics.DiscoveryPacket(other.entity, False), index)
+
+    # Assign infinity to latency - Kaifei Chen(kaifei@berkeley.edu)
+    if not other.shadow:
+      other.entity.handle_rx(sim.basics.DiscoveryPacket(self.entity, latency=float("inf")), otherPort)
+    if not self.shadow:
+      self.entity.handle_rx(sim.basics.DiscoveryPacket(other.entity, latency=float("inf")), index)
+
+    if other.ports[otherPort] is not None:
+      # (It's already free if the link only went one way)
+      other.ports[otherPort] = None
+      heapq.heappush(other._free, otherPort)
+      other._dropNeighbor(self, otherPort)
+    self.ports[index] = None
+    heapq.heappush(self._free, index)
+    self._dropNeighbor(other, index)
+    other._portsChanged()
+    self._portsChanged()
+
+  def _portsChanged (self):
+    self._live = None
+
+  def _dropNeighbor (self, other, index):
+    ports = self._neighbors.get(other)
+    if ports is None or index not in ports: return
+    ports.remove(index)
+    if not ports:
+      del self._neighbors[other]
+
+  def _livePorts (self):
+    live = self._live
+    if live is None:
+      live = self._live = [n for n,p in enumerate(self.ports) if p is not None]
+    return live
 
   def isConnectedTo (self, other):
-    other = topoOf(other)
-    for p in self.ports:
-      if p is None: continue
-      if p.dst is other:
-        return True
-    return False
+    return topoOf(other) in self._neighbors
 
   def disconnect (self):
-    for p in (port for port in self.ports if port):
-      self.unlinkTo(p.dst)
+    # Unlink each neighbor once, in the order of their first ports
+    first = sorted((ports[0], other) for other,ports in self._neighbors.items())
+    for index,other in first:
+      self.unlinkTo(other)
 
   def send (self, packet, port, flood = False):
     """
@@ -355,12 +1122,14 @@ class TopoNode (object):
     If flood is True, Port can be a port number NOT to flood out of
     or None to flood all ports.
     """
+    if self.shadow: return
     packet.ttl -= 1
     if packet.ttl == 0:
-      simlog.warning("Expired %s / %s", packet, ','.join(e.name for e in packet.trace))
+      simlog.warning("Expired %s / %s", packet, packet.trace)
       return
     if (packet.src is None) or (packet.src is NullAddress):
       packet.src = self.entity
+      packet.src_id = self.entity._serial
 
     if not isinstance(port, list):
       ports = [port]
@@ -370,23 +1139,142 @@ class TopoNode (object):
       ports = port
 
     if flood:
-      ports = [p for p in  range(0, len(self.ports)) if p not in ports]
+      live = self._livePorts()
+      if len(ports) == 1:
+        # The usual case: everywhere except where it came from (or None)
+        skip = ports[0]
+        ports = live if skip is None else [p for p in live if p != skip]
+      else:
+        skip = set(ports)
+        ports = [p for p in live if p not in skip]
 
     for remote in ports:
       if remote >=0 and remote < len(self.ports):
         remote = self.ports[remote]
         if remote is not None:
-          p = copy.copy(packet)
-          import basics
-          if isinstance(packet, basics.RoutingUpdate):
-            p.paths = copy.copy(packet.paths)
-          remote.transfer(p)
+          # Copies share whatever they can with the original (see
+          # RoutingUpdate, for example)
+          remote.transfer(copy.copy(packet))
+    packet._sent()
+
+
+class Registry (object):
+  """
+  Keeps track of the entities by name.
+
+  If _BUILTIN_NAMES is set in __main__ (or .builtins is set to True), each
+  entity is also made a builtin with its name, so that it can be used
+  from anywhere (like the console) just by typing the name.
+  """
+  def __init__ (self, topo = None):
+    self._entities = {}
+    # The same simulation's entity -> TopoNode dict (see Simulation)
+    self.topo = topo
+    # Entity ID -> entity, or None (entities stay in here even once
+    # they're removed, so that old packet traces can still be read)
+    self._by_id = []
+    # The names in order (None when it needs sorting again)
+    self._sorted = None
+    # None means to do what __main__ says
+    self.builtins = None
+
+  def _use_builtins (self):
+    if self.builtins is not None: return self.builtins
+    return sys.modules['__main__'].__dict__.get("_BUILTIN_NAMES", False)
+
+  def _check (self, name):
+    """ Raises NameError if name can't be used for a new entity. """
+    if name in self._entities or (self._use_builtins() and
+                                  name in sys.modules['__builtin__'].__dict__):
+      raise NameError(str(name) + " already exists")
+
+  def add (self, e):
+    self._check(e.name)
+    self._entities[e.name] = e
+    by_id = self._by_id
+    i = e._serial
+    if i >= len(by_id):
+      by_id.extend([None] * (i + 1 - len(by_id)))
+    by_id[i] = e
+    self._sorted = None
+    if self._use_builtins():
+      sys.modules['__builtin__'].__dict__[e.name] = e
+
+  def get (self, name, default = None):
+    return self._entities.get(name, default)
+
+  def __getitem__ (self, name):
+    return self._entities[name]
+
+  def by_id (self, i):
+    """ Returns the entity with the given ID (or None). """
+    if i < 0: return None
+    try:
+      return self._by_id[i]
+    except IndexError:
+      return None
 
+  def id_limit (self):
+    """
+    Returns one more than the biggest entity ID, so that a list that long
+    can be indexed by ID.
+    """
+    return len(self._by_id)
+
+  def __contains__ (self, name):
+    return name in self._entities
+
+  def __len__ (self):
+    return len(self._entities)
+
+  def __iter__ (self):
+    return iter(self.names())
+
+  def names (self, prefix = ''):
+    """ Returns the names (that start with prefix) in order. """
+    names = self._sorted
+    if names is None:
+      names = self._sorted = sorted(self._entities)
+    if not prefix: return list(names)
+    lo = bisect.bisect_left(names, prefix)
+    hi = lo
+    while hi < len(names) and names[hi].startswith(prefix):
+      hi += 1
+    return names[lo:hi]
+
+  def entities (self, prefix = ''):
+    """ Returns the entities (whose names start with prefix) in order. """
+    return [self._entities[n] for n in self.names(prefix)]
+
+  def remove (self, *names):
+    """
+    Forgets the entities with the given names, and takes them out of the
+    topology so that nothing which goes through the entities sees them.
+    That's all it does: it doesn't take down their links (see
+    Entity.remove() for taking one out of the simulation).
+    """
+    builtins = sys.modules['__builtin__'].__dict__
+    for name in names:
+      e = self._entities.pop(name, None)
+      if e is None: continue
+      if builtins.get(name) is e:
+        del builtins[name]
+      if self.topo is not None:
+        self.topo.pop(e, None)
+    self._sorted = None
+
+  def clear (self, prefix = ''):
+    """
+    Forgets all the entities (whose names start with prefix) like
+    remove(), so their names can be used for new ones.  Their links stay
+    up, so clear a whole topology at once, or remove() any entity that
+    others are still linked to first.
+    """
+    self.remove(*self.names(prefix))
 
 def _getByName (name):
-  return topoOf(sys.modules['__builtin__'].__dict__.get(name, None))
+  return topoOf(entities.get(name))
 
-topo = weakref.WeakValueDictionary()
 def CreateEntity (_name, _kind, *args, **kw):
   """
   Creates an Entity of kind, where kind is an Entity subclass.
@@ -394,9 +1282,17 @@ def CreateEntity (_name, _kind, *args, **kw):
   Additional arguments are pased to the new Entity's __init__().
   Returns the TopoNode containing the new Entity.
   """
-  if _name in sys.modules['__builtin__'].__dict__:
-    raise NameError(str(_name) + " already exists")
   import api
+  e = _create(_name, _kind, args, kw)
+
+  kind = "host" if isinstance(e, api.HostEntity) else "switch"
+  world.do(events.send_entity_up,e.name, kind)
+  simlog.info(e.name+" up!")
+  return e
+
+def _create (_name, _kind, args, kw):
+  """ Does the work of CreateEntity() without telling anyone about it. """
+  entities._check(_name)
 
   e = _kind(*args, **kw)
   setattr(e, 'name', _name)
@@ -409,64 +1305,117 @@ def CreateEntity (_name, _kind, *args, **kw):
   te = TopoNode(numPorts, growPorts)
   te.entity = e
 
-  kind = "host" if isinstance(e, api.HostEntity) else "switch"
-  world.do(events.send_entity_up,e.name, kind)
-  simlog.info(e.name+" up!")
+  _wire(e, te)
 
-  # Add working methods
-  setattr(e, 'get_port_count', lambda : len(te.ports))
-  def send (packet, port=None, flood=False):
-    te.send(packet, port, flood)
-  setattr(e, 'send', send)
-  def set_debug (*args):
-    #print e.name + ':', ' '.join((str(s) for s in args))
-    world.do(events.set_debug,e.name, ' '.join((str(s) for s in args)))
-  setattr(e, 'set_debug', set_debug)
-  def log (msg, *args, **kw):
-    level = "debug"
-    if "level" in kw:
-      level = kw["level"].lower()
-      del kw["level"]
-    if level not in ['debug', 'info', 'warning', 'error', 'critical', 'exception']:
-      level = "debug"
-    func = getattr(userlog, level)
-    msg = "%s:" + msg # Black magic
-    args = tuple([e.name] + list(args))
-    func(msg, *args, **kw)
-  setattr(e, 'log', log)
-
-  for m in ['linkTo', 'unlinkTo', 'disconnect']:
-    setattr(e, m, getattr(te, m))
-
-  def remove ():
-    te.disconnect()
-    world.do(events.send_entity_down,_name)
-    try:
-      del sys.modules['__builtin__'].__dict__[_name]
-    except:
-      pass
-  setattr(e, 'remove', remove)
-
-  # Make a global variable with the right name
-  #sys.modules['__main__'].__dict__[_name] = e
-  #sim.__dict__[_name] = e
-  sys.modules['__builtin__'].__dict__[_name] = e
+  entities.add(e)
 
   # This is so we can find its TopoNode
   topo[e] = te
   return e
 
+def _wire (e, te):
+  """ Connects Entity e to its TopoNode te. """
+  # Everything the entity does with the network (its send(), linkTo() and
+  # so on) goes through this
+  e._topo = te
+
 def topoOf (entity):
   """ Get TopoNode that contains entity.  Students never use this. """
   if type(entity) is TopoNode:
     # We were actually passed a topo object
     return entity
-  t = topo.get(entity, None)
-  return t
-
-world = World()
-events = interface.interface()
+  return getattr(entity, '_topo', None)
 
-def simulate ():
-  """ Runs the simulator. """
+class Simulation (object):
+  """
+  A whole simulation: its World, its entities (by name, in .entities) and
+  their TopoNodes (in .topo), where its events get reported (.events) and
+  its random number streams.
+
+  There's always a default one, which talks to the GUI.  Others can be
+  made alongside it -- to run lots of small simulations one after
+  another in the same process, for example:
+
+    s = Simulation(virtual = True)
+    with s:
+      scenario.create()
+      s.world.run_until_quiet()
+
+  Only one simulation is current at a time.  The simulator's functions
+  (and the module variables here like world, events and topo) work on the
+  current one, so switch with activate() or a with statement, and don't
+  switch away from one whose World is running in its own thread.
+  """
+  def __init__ (self, events = None, virtual = False):
+    self.world = World(virtual)
+    if events is None:
+      events = comm.NullInterface()
+    self.events = events
+    self.topo = weakref.WeakValueDictionary()
+    self.entities = Registry(self.topo)
+    if simulation is not None:
+      # Only the default simulation's entities can be builtins
+      self.entities.builtins = False
+    self.seed = None
+    self.streams = {}
+    self.serial = itertools.count()
+    self._previous = []
+
+  def activate (self):
+    """ Makes this the current simulation.  Returns the one that was. """
+    global simulation, world, events, entities, topo, _seed, _streams
+    old = simulation
+    if old is self: return old
+    api = sys.modules.get('sim.api')
+    if old is not None:
+      # Things like checkpoint.load() and seed() change these directly
+      old.world,old.events,old.entities,old.topo = world,events,entities,topo
+      old.seed,old.streams = _seed,_streams
+      if hasattr(api, '_entity_serial'):
+        old.serial = api._entity_serial
+
+    simulation = self
+    world,events,entities,topo = self.world,self.events,self.entities,self.topo
+    _seed,_streams = self.seed,self.streams
+    cable = sys.modules.get('sim.cable')
+    if hasattr(cable, 'events'):
+      cable.world = world
+      cable.events = events
+    if hasattr(api, '_entity_serial'):
+      api._entity_serial = self.serial
+    return old
+
+  def __enter__ (self):
+    self._previous.append(self.activate())
+    return self
+
+  def __exit__ (self, *exc):
+    old = self._previous.pop()
+    if old is not None:
+      old.activate()
+
+simulation = None
+Simulation().activate()
+# Only the default simulation talks to the GUI (and listens for it)
+events = simulation.events = interface.interface()
+
+def simulate (virtual_time = None, random_seed = None):
+  """
+  Runs the simulator.
+  If virtual_time is True, the simulation clock jumps from event to event
+  instead of following the wall clock, which is what you want for headless
+  runs.  Leave it off when using NetVis.  If it's None, it's taken from
+  _VIRTUAL_TIME in __main__ (off if that isn't set).
+  If random_seed is given (or _RANDOM_SEED is set in __main__), the random
+  number streams are seeded with it.  A seeded run in virtual time is
+  exactly reproducible.
+  """
+  main = sys.modules['__main__'].__dict__
+  if virtual_time is None:
+    virtual_time = main.get("_VIRTUAL_TIME", False)
+  if random_seed is None:
+    random_seed = main.get("_RANDOM_SEED")
+  if random_seed is not None:
+    seed(random_seed)
+  world.virtual = virtual_time
   world.start()
@@ -0,0 +1,272 @@
+"""
+Runs a simulation in parallel across several processes.
+
+Build the topology as usual (but don't start the simulator), then call
+simulate().  The entities are split into partitions, and each partition
+is run by its own process with its own World, in virtual time.  Every
+process has a copy of the whole topology, but entities belonging to other
+partitions are just shadows: none of their code runs there (their timers
+and the packets on their way to them are dropped, and they aren't told
+about links going down), and they never send anything.  (A timer whose
+target isn't one of the entity's methods -- a lambda, say -- can't be
+traced back to it, though, and still goes off.)  A packet put on a
+cable leading into another partition is shipped to that partition's
+process instead of being scheduled locally.  Entities which have been
+removed don't run anywhere, and packets sent to them before their links
+go down are dropped.
+
+Synchronization is conservative: all the processes run up to the earliest
+pending event plus the lookahead -- the smallest latency of any cable
+that crosses between partitions -- and then swap the packets which crossed
+over.  Nothing sent during a window can arrive before the window ends, so
+no process ever sees an event out of order.
+
+Students should never need to touch this.
+"""
+
+import multiprocessing
+import cPickle
+import cStringIO
+import struct
+
+import api
+import core
+import comm
+import cable
+
+
+def partition (count):
+  """
+  Splits the entities into count partitions of (nearly) equal size.
+  Entities are taken in breadth-first order, so neighbors tend to end up
+  in the same partition.  Returns a dict of entity name -> partition.
+  """
+  nodes = sorted(core.topo.values(), key = lambda te: te.entity._serial)
+  # (Entities which have been removed may still have links for a moment)
+  live = set(nodes)
+  order = []
+  seen = set()
+  for start in nodes:
+    if start in seen: continue
+    seen.add(start)
+    frontier = [start]
+    while frontier:
+      te = frontier.pop(0)
+      order.append(te)
+      for p in te.ports:
+        if p is not None and p.dst in live and p.dst not in seen:
+          seen.add(p.dst)
+          frontier.append(p.dst)
+
+  size = -(-len(order) // count)
+  return dict((te.entity.name, i // size) for i,te in enumerate(order))
+
+
+def lookahead (owner):
+  """
+  Returns the smallest latency of any cable between two partitions.
+  owner is a dict of entity name -> partition.
+  """
+  la = float("inf")
+  for te in core.topo.values():
+    for c in te.ports:
+      if c is None: continue
+      dst = owner.get(c.dstEnt.name)
+      if dst is None or owner[c.srcEnt.name] == dst: continue
+      if not isinstance(c, cable.BasicCable):
+        raise RuntimeError("Can't tell the latency of %s" % (c,))
+      la = min(la, c.latency)
+  return la
+
+
+def simulate (partitions = None, until = None, collect = None, owner = None):
+  """
+  Runs the topology in partitions processes (one per CPU by default).
+  Runs until the simulation time until, or until nothing is left to
+  happen.
+  collect, if given, is called in each process at the end with the list
+  of entities that ran there.  It should return a dict; the dicts from all
+  the processes are merged and returned.  Entities in it come back as
+  the corresponding entities in this process.
+  owner can be used to choose the partitions yourself (a dict of entity
+  name -> partition number); the default is partition().
+  """
+  assert not core.world._started, "Can't run in parallel once started"
+  if owner is None:
+    if partitions is None:
+      partitions = multiprocessing.cpu_count()
+    owner = partition(partitions)
+  missing = [te.entity.name for te in core.topo.values()
+             if te.entity.name not in owner]
+  if missing:
+    raise RuntimeError("No partition for " + ", ".join(sorted(missing)))
+  partitions = max(owner.values()) + 1
+  la = lookahead(owner)
+  if la <= 0:
+    raise RuntimeError("Parallel simulation needs cable latencies > 0")
+
+  conns = []
+  procs = []
+  for i in range(partitions):
+    parent_end,child_end = multiprocessing.Pipe()
+    p = multiprocessing.Process(target = _worker,
+                                args = (child_end, i, owner, collect))
+    p.daemon = True
+    p.start()
+    conns.append(parent_end)
+    procs.append(p)
+
+  inf = float("inf")
+  nexts = [c.recv() for c in conns]
+  inbound = [[] for c in conns]
+  while True:
+    pending = [t for box in inbound for t,blob in box]
+    gmin = min(nexts + pending + [inf])
+    if gmin == inf: break
+    if until is not None and gmin > until: break
+
+    end = gmin + la
+    inclusive = False
+    if until is not None and end > until:
+      end = until
+      inclusive = True
+
+    for c,box in zip(conns, inbound):
+      c.send(('run', end, inclusive, [blob for t,blob in box]))
+    inbound = [[] for c in conns]
+    for i,c in enumerate(conns):
+      out,nexts[i] = c.recv()
+      for dst,t,blob in out:
+        inbound[dst].append((t, blob))
+    if inclusive: break
+
+  results = {}
+  for c in conns:
+    c.send(('collect',))
+  for c in conns:
+    r = _loads(c.recv_bytes())
+    if r: results.update(r)
+  for c,p in zip(conns, procs):
+    c.send(('stop',))
+    p.join()
+  return results
+
+
+def _worker (conn, index, owner, collect):
+  world = core.world
+  world.virtual = True
+
+  # Only the parent talks to the GUI
+  null = comm.NullInterface()
+  core.events = null
+  cable.events = null
+
+  # Partition by entity ID, so a packet leaving doesn't need a name lookup
+  part = [None] * core.entities.id_limit()
+  for te in core.topo.values():
+    part[te.entity._serial] = owner[te.entity.name]
+
+  outbox = []
+  def post (c, packet):
+    dst = part[c.dstEnt._serial]
+    t = world.now() + c.latency
+    outbox.append((dst, t, _dumps((t, c.srcEnt._serial, c.srcPort, packet))))
+
+  # Entities which have been removed (whose links are about to go down)
+  # don't run anywhere
+  for te in core.topo.values():
+    for c in te.ports:
+      if c is not None and part[c.dstEnt._serial] is None:
+        c.dst.shadow = True
+
+  local = []
+  for te in core.topo.values():
+    if owner[te.entity.name] != index:
+      te.shadow = True
+      continue
+    local.append(te.entity)
+    for c in te.ports:
+      if c is None: continue
+      dst = part[c.dstEnt._serial]
+      if dst is None:
+        c.launch = lambda packet: None
+      elif dst != index:
+        c.launch = lambda packet, c=c: post(c, packet)
+
+  # Nothing that was scheduled for a shadow should happen here
+  for seconds,h in world._prelist:
+    if _for_shadow(h):
+      h.cancel()
+
+  inf = float("inf")
+  world._flush_prelist()
+  nxt = world.next_event_time()
+  conn.send(inf if nxt is None else nxt)
+
+  while True:
+    msg = conn.recv()
+    if msg[0] == 'run':
+      end,inclusive,inbound = msg[1:]
+      for blob in inbound:
+        t,src,port,packet = _loads(blob)
+        c = core.entities.by_id(src)._topo.ports[port]
+        world._add(t, core.Delivery(world, c, packet))
+      world.run_until(end if inclusive else _before(end))
+      nxt = world.next_event_time()
+      conn.send((outbox[:], inf if nxt is None else nxt))
+      del outbox[:]
+    elif msg[0] == 'collect':
+      conn.send_bytes(_dumps(collect(local) if collect else None))
+    elif msg[0] == 'stop':
+      break
+
+
+def _for_shadow (h):
+  """
+  Returns whether the event h would run a shadow's code: delivering a
+  packet to it, arming one of its timers, or calling one of its methods.
+  """
+  if type(h) is core.Delivery:
+    return h.cable.dst.shadow
+  if h.args and isinstance(h.args[0], core.Timer):
+    target = getattr(h.args[0].func, 'im_self', None)
+  else:
+    target = getattr(h.method, 'im_self', None)
+  if not isinstance(target, api.Entity): return False
+  return target._topo is not None and target._topo.shadow
+
+
+def _before (t):
+  """ Returns the largest float smaller than t (which must be > 0). """
+  bits = struct.unpack('<q', struct.pack('<d', t))[0]
+  return struct.unpack('<d', struct.pack('<q', bits - 1))[0]
+
+
+# Packets (and results) cross between processes pickled, with references
+# to entities turned into their IDs.  Each process has the whole topology
+# (forked from the same one), so the ID finds the same entity on the other
+# side.
+
+def _persistent_id (obj):
+  if isinstance(obj, api.Entity):
+    return obj._serial
+  if obj is core.NullAddress:
+    return "n"
+  return None
+
+def _persistent_load (pid):
+  if pid == "n":
+    return core.NullAddress
+  return core.entities.by_id(pid)
+
+def _dumps (obj):
+  f = cStringIO.StringIO()
+  p = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+  p.persistent_id = _persistent_id
+  p.dump(obj)
+  return f.getvalue()
+
+def _loads (s):
+  u = cPickle.Unpickler(cStringIO.StringIO(s))
+  u.persistent_load = _persistent_load
+  return u.load()
@@ -0,0 +1,174 @@
+"""
+Keeps statistics about the simulator's scheduler.
+
+Every World has one of these as world.telemetry.  It counts the events
+the world dispatches (broken down by what kind of callback they were),
+keeps an eye on how far behind the clock the world is running in real
+time, and every so often takes a sample of how deep the queue is.  It's
+meant to be cheap enough to leave on all the time; if it's not wanted,
+set .enabled to False.
+
+Try "print world.telemetry" from the console.
+
+Students should never need to touch this.
+"""
+
+import collections
+import time
+import logging
+
+log = logging.getLogger("simulator")
+
+class Telemetry (object):
+  def __init__ (self, world, interval = 1.0, history = 600):
+    self.world = world
+    self.enabled = True
+
+    # Seconds (of wall clock) between samples, and how many to keep
+    self.interval = interval
+    self.samples = collections.deque(maxlen = history)
+    self._next_sample = 0
+
+    # In real time, a warning is logged (at most once per sample) when an
+    # event is dispatched more than this many seconds late
+    self.lag_warning = 0.1
+
+    self.dispatched = 0
+    self.batches = 0
+    self.lag_max = 0.0
+    self._lag_total = 0.0
+    self._lag_window = 0.0
+
+    # Callback (a code object, or a name for builtins) -> count, and the
+    # (kind, name) each of them is reported as
+    self._counts = collections.defaultdict(int)
+    self._labels = {}
+
+    self._start = time.time()
+
+  def reset (self):
+    """ Forgets everything counted so far. """
+    self.__init__(self.world, self.interval, self.samples.maxlen)
+
+  def count (self, batch):
+    """ Called by the world with each batch of events it dispatches. """
+    counts = self._counts
+    for h in batch:
+      m = h.method
+      f = getattr(m, 'im_func', m)
+      key = getattr(f, 'func_code', None)
+      if key is None: key = getattr(f, '__name__', None)
+      if key not in counts:
+        self._labels[key] = _classify(h)
+      counts[key] += 1
+    self.dispatched += len(batch)
+    self.batches += 1
+
+    now = time.time()
+    if now >= self._next_sample:
+      self._sample(now)
+
+  def lag (self, seconds):
+    """ Called by the world with how late (in sim time) a batch is. """
+    self._lag_total += seconds
+    if seconds > self._lag_window:
+      self._lag_window = seconds
+      if seconds > self.lag_max:
+        self.lag_max = seconds
+
+  def _sample (self, now):
+    world = self.world
+    timers = world.timers
+    self.samples.append((now, world.now(),
+                         len(world._heap) - world._dead,
+                         timers._size - timers._dead,
+                         self.dispatched, self._lag_window))
+    if self._lag_window > self.lag_warning and not world.virtual:
+      log.warning("Simulator is running %.3f seconds behind", self._lag_window)
+    self._lag_window = 0.0
+    self._next_sample = now + self.interval
+
+  def queue_depth (self):
+    """ Returns (events, timers) that are currently pending. """
+    world = self.world
+    return (len(world._heap) - world._dead,
+            world.timers._size - world.timers._dead)
+
+  def rate (self):
+    """ Returns events dispatched per second over the last sample. """
+    if len(self.samples) < 2:
+      elapsed = time.time() - self._start
+      return self.dispatched / elapsed if elapsed > 0 else 0.0
+    a,b = self.samples[-2],self.samples[-1]
+    if b[0] <= a[0]: return 0.0
+    return (b[4] - a[4]) / (b[0] - a[0])
+
+  def mean_lag (self):
+    """ Returns the average dispatch lag of a batch (in real time). """
+    if not self.batches: return 0.0
+    return self._lag_total / self.batches
+
+  def breakdown (self, detail = False):
+    """
+    Returns a dict of kind of callback -> number of events dispatched.
+    The kinds are 'cable rx', 'timer', 'link up', 'link down', 'gui' and
+    'other'.  With detail, the keys are (kind, callback name) instead.
+    """
+    r = collections.defaultdict(int)
+    for key,count in self._counts.items():
+      kind,name = self._labels[key]
+      r[(kind,name) if detail else kind] += count
+    return dict(r)
+
+  def report (self):
+    """ Returns everything as a dict. """
+    events,timers = self.queue_depth()
+    return {
+      'dispatched' : self.dispatched,
+      'events_per_second' : self.rate(),
+      'pending_events' : events,
+      'pending_timers' : timers,
+      'mean_lag' : self.mean_lag(),
+      'max_lag' : self.lag_max,
+      'breakdown' : self.breakdown(),
+      'samples' : list(self.samples),
+    }
+
+  def __str__ (self):
+    events,timers = self.queue_depth()
+    o = ["%i events dispatched (%.0f/sec); %i events and %i timers pending"
+         % (self.dispatched, self.rate(), events, timers)]
+    if not self.world.virtual:
+      o.append("lag: %.4f mean, %.4f max" % (self.mean_lag(), self.lag_max))
+    for kind,count in sorted(self.breakdown().items(), key=lambda x:-x[1]):
+      o.append("  %-10s %i" % (kind, count))
+    return "\n".join(o)
+
+
+def _classify (h):
+  """ Returns (kind, name) for the callback of event h. """
+  import cable
+  import comm
+  import wheel
+
+  m = h.method
+  f = getattr(m, 'im_func', m)
+  name = getattr(f, '__name__', repr(f))
+  owner = getattr(m, 'im_self', getattr(h, 'cable', None))
+  if owner is not None:
+    name = type(owner).__name__ + "." + name
+
+  if isinstance(owner, cable.Cable):
+    kind = 'cable rx'
+  elif isinstance(owner, wheel.TimerWheel):
+    kind = 'timer'
+  elif name.endswith('send_link_up'):
+    kind = 'link up'
+  elif name.endswith('goDown') or name.endswith('send_link_down'):
+    kind = 'link down'
+  elif (isinstance(owner, comm.NullInterface)
+        or (getattr(f, '__module__', None) or '').split('.')[-1].startswith('comm')):
+    kind = 'gui'
+  else:
+    kind = 'other'
+  return (kind, name)
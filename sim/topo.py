@@ -3,6 +3,7 @@ Provides an API for connecting and disconnecting Entities.
 You should only use this to build your own test scenarios
 """
 
+import core
 from core import topoOf
 
 def link (entity1, entity2, latency=None):
@@ -30,3 +31,48 @@ def show_ports (entity):
     p1 = "%s:%i" % (p[0],p[1])
     p2 = "%s:%i" % (p[2],p[3])
     print "%14s <-> %-14s" % (p1,p2)
+
+def build (entities, links = ()):
+  """
+  Creates lots of entities and links at once, which is much quicker for
+  big topologies than creating and linking them one by one.
+
+  entities is a list of (name, kind) pairs; anything after the kind is
+  passed to its __init__().  links is a list of (a, b) or (a, b, latency),
+  where a and b are entities or their names (they can be ones from
+  entities or ones that already exist).
+
+  Rather than an event per entity and per link, the GUI is sent the whole
+  topology once, and the DiscoveryPackets for all of the links are sent
+  together when the simulation gets going.  Returns the new entities.
+  """
+  created = []
+  names = {}
+  for spec in entities:
+    e = core._create(spec[0], spec[1], spec[2:], {})
+    created.append(e)
+    names[e.name] = topoOf(e)
+
+  def find (x):
+    if isinstance(x, basestring):
+      te = names.get(x) or core._getByName(x)
+      if te is None:
+        raise NameError("No entity named " + x)
+      return te
+    return topoOf(x)
+
+  new = []
+  for link in links:
+    a = find(link[0])
+    b = find(link[1])
+    latency = link[2] if len(link) > 2 else None
+    new.append((a, b) + a._connect(b, None, True, latency))
+
+  core.world.do(_discover, new)
+  core.world.do(core.events.send_initialize)
+  core.simlog.info("%i entities and %i links up", len(created), len(new))
+  return created
+
+def _discover (links):
+  for a,b,aPort,bPort in links:
+    a._discover(b, aPort, bPort)
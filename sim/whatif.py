@@ -0,0 +1,172 @@
+"""
+Tries out lots of failures against the same converged network.
+
+Build a topology and call explore() with a list of variants -- functions
+which break something, like unlinking two switches.  The network is run
+until it converges once, and then a process is forked for each variant.
+The forks start out sharing the converged network (copy-on-write), so
+nothing has to be rebuilt; each one applies its variant, runs until the
+network converges again, and reports back what happened:
+
+  import sim.whatif as whatif
+  for r in whatif.explore(whatif.every_link(), until = 300):
+    print r['name'], r['convergence_time'], r['packets'].get('RoutingUpdate')
+
+Everything runs in virtual time.  Variants run one per CPU at a time.
+
+Students should never need to touch this.
+"""
+
+import multiprocessing
+import functools
+
+import core
+import comm
+import cable
+import topo
+
+
+def every_link ():
+  """
+  Returns a variant for each link, which unlinks it.
+  The variants are named "a-b" after the entities on either end.
+  """
+  links = set()
+  for te in core.topo.values():
+    for c in te.ports:
+      if c is None: continue
+      a,b = sorted([c.srcEnt.name, c.dstEnt.name])
+      links.add((a,b))
+  return [("%s-%s" % (a,b), functools.partial(_unlink, a, b))
+          for a,b in sorted(links)]
+
+def every_node ():
+  """
+  Returns a variant for each entity with links, which disconnects it.
+  The variants are named after the entity.
+  """
+  names = sorted(te.entity.name for te in core.topo.values()
+                 if any(c is not None for c in te.ports))
+  return [(name, functools.partial(_disconnect, name)) for name in names]
+
+def _unlink (a, b):
+  topo.unlink(core._getByName(a), core._getByName(b))
+
+def _disconnect (name):
+  topo.disconnect(core._getByName(name))
+
+
+def explore (variants, until = None, probe = None, measure = None,
+             processes = None):
+  """
+  Runs each of the variants against the converged network.
+
+  variants is a list of functions, or of (name, function) pairs.  until is
+  how long (in simulation seconds) to let the network try to converge, the
+  first time and after each variant; the default is to wait as long as it
+  takes.  probe, if given, is called once the network has converged after
+  a variant -- for example, to send some pings -- and the network is then
+  run until it settles again.  measure, if given, is called at the end and
+  its result (which must be picklable, so use names instead of entities)
+  is put in the report.
+
+  Returns a list with a dict for each variant (in the same order):
+   name              The variant's name (or its index)
+   converged         Whether the network settled down before until
+   convergence_time  How long it took, in simulation seconds (or None)
+   events            How many events were dispatched
+   packets           Dict of packet class name -> times one was sent
+                     over a cable
+   pings_sent        Pings sent ...
+   pings_lost        ... and how many of those never got a Pong back
+   measure           What measure() returned (if given)
+  """
+  global _job
+  world = core.world
+  assert world._thread is None, "Can't explore once the world has started"
+  world.virtual = True
+  _settle(until)
+
+  named = []
+  for i,v in enumerate(variants):
+    if not isinstance(v, tuple): v = (i, v)
+    named.append(v)
+
+  # The forked processes find the job here; it isn't pickled
+  _job = (named, until, probe, measure)
+  pool = multiprocessing.Pool(processes, maxtasksperchild = 1)
+  try:
+    return pool.map(_explore_one, range(len(named)), chunksize = 1)
+  finally:
+    pool.close()
+    pool.join()
+    _job = None
+
+_job = None
+
+
+def _settle (until):
+  """
+  Runs the world until it goes quiet (or until more time than until has
+  passed).  Returns how long it took for the last control packet to
+  arrive, or None if it didn't settle in time.
+  """
+  world = core.world
+  start = world.now()
+  if world.run_until_quiet(None if until is None else start + until) is None:
+    return None
+  t = world.control_quiet_time
+  if t is None or t < start: return 0.0
+  return t - start
+
+
+class _Counter (comm.NullInterface):
+  """ Stands in for the GUI, and counts the packets going by. """
+  def __init__ (self):
+    self.packets = {}
+    self.pings_sent = 0
+    self.pongs_home = 0
+
+  def packet (self, n1, n2, packet, duration, drop=False):
+    import basics
+    kind = type(packet).__name__
+    self.packets[kind] = self.packets.get(kind, 0) + 1
+    t = type(packet)
+    if t is basics.Ping:
+      # Count each ping once, as it leaves the host that sent it
+      if n1 == packet.src.name: self.pings_sent += 1
+    elif t is basics.Pong:
+      if n2 == packet.dst.name: self.pongs_home += 1
+
+
+def _explore_one (index):
+  named,until,probe,measure = _job
+  name,variant = named[index]
+
+  world = core.world
+  # Nothing in this process should touch the parent's sockets
+  world._readers.clear()
+  world._writers.clear()
+  counter = _Counter()
+  core.events = counter
+  cable.events = counter
+
+  dispatched = world.telemetry.dispatched
+  variant()
+  elapsed = _settle(until)
+  if probe is not None and elapsed is not None:
+    probe()
+    _settle(until)
+
+  r = {
+    'name' : name,
+    'converged' : elapsed is not None,
+    'convergence_time' : elapsed,
+    'events' : world.telemetry.dispatched - dispatched,
+    'packets' : counter.packets,
+    'pings_sent' : counter.pings_sent,
+    'pings_lost' : max(0, counter.pings_sent - counter.pongs_home),
+  }
+  if measure is not None:
+    r['measure'] = measure()
+  return r
@@ -0,0 +1,197 @@
+"""
+A hierarchical timing wheel for the simulator's timers.
+
+Timers are bucketed by the tick they expire on, so arming and cancelling
+one is O(1) no matter how many are pending, and all the timers which
+expire on the same tick fire together in a single sweep.  Only the next
+sweep is ever scheduled with the World, so timers don't crowd the event
+heap that packet deliveries go through.
+
+Students should never need to touch this.
+"""
+
+import math
+
+import core
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+
+class TimerWheel (object):
+  """
+  Holds timers (core.Timer and friends) for a World.
+
+  Level 0 has one slot per tick.  Each slot on level n covers a whole
+  turn of level n-1, and its timers are cascaded down a level when the
+  wheel gets there.  Timers too far out for the top level wait in an
+  overflow list.  A timer is cancelled by setting its .stopped flag; it
+  is just skipped when its slot comes up.  If stopped timers come to
+  make up more than compact_fraction of the wheel, they're swept out
+  all at once.
+  """
+  def __init__ (self, world, resolution = 0.001):
+    self.world = world
+    self.resolution = resolution
+
+    self._wheels = [[[] for _ in range(SLOTS)] for _ in range(LEVELS)]
+    self._overflow = []
+
+    # The last tick that has been swept (None until the first timer)
+    self._tick = None
+
+    # The tick the next sweep is scheduled for, if any
+    self._sweep_tick = None
+
+    # Number of timers in the wheel, and how many of those are stopped
+    self._size = 0
+    self._dead = 0
+    self.compact_fraction = 0.5
+
+  def add (self, timer, seconds):
+    """ Arms timer to go off in the given number of seconds. """
+    if not self.world._is_world_thread():
+      # The wheel belongs to the world thread
+      self.world.do(self.add, timer, seconds)
+      return
+    now = self.world.now()
+    if self._sweep_tick is None:
+      # Nothing is pending, so catch the wheel up to the present
+      self._tick = int(math.floor(now / self.resolution))
+    timer._deadline = now + seconds
+    self._arm(timer)
+
+  def cancelled (self, timer):
+    """ Called when a timer has been stopped. """
+    if not self.world._is_world_thread():
+      self.world.do(self.cancelled, timer)
+      return
+    if not getattr(timer, '_queued', False): return
+    self._dead += 1
+    if self._dead > 64 and self._dead > self._size * self.compact_fraction:
+      self._compact()
+
+  def _compact (self):
+    self._size = 0
+    for slots in self._wheels + [[self._overflow]]:
+      for slot in slots:
+        live = []
+        for timer in slot:
+          if timer.stopped:
+            timer._queued = False
+          else:
+            live.append(timer)
+        slot[:] = live
+        self._size += len(live)
+    self._dead = 0
+
+  def pending (self):
+    """ Returns the timers which are armed, soonest first. """
+    timers = [timer for slots in self._wheels + [[self._overflow]]
+              for slot in slots for timer in slot if not timer.stopped]
+    timers.sort(key = lambda timer: timer._tick)
+    return timers
+
+  def _take (self, slot):
+    """ Takes the timers out of a slot; returns the live ones. """
+    self._size -= len(slot)
+    live = []
+    for timer in slot:
+      timer._queued = False
+      if timer.stopped:
+        self._dead -= 1
+      else:
+        live.append(timer)
+    return live
+
+  def rearm (self, timer):
+    """ Arms timer again, one period after it last went off. """
+    timer._deadline += timer.seconds
+    self._arm(timer)
+
+  def _arm (self, timer):
+    # The small fudge keeps a deadline which is a whole number of ticks
+    # from landing on the next tick because of floating point error.
+    tick = int(math.ceil(timer._deadline / self.resolution - 1e-6))
+    if tick <= self._tick:
+      tick = self._tick + 1
+    timer._tick = tick
+
+    visit = self._place(timer)
+    if self._sweep_tick is None or visit < self._sweep_tick:
+      self._schedule(visit)
+
+  def _place (self, timer):
+    """
+    Puts timer in the right slot relative to the current tick.
+    Returns the tick at which the wheel needs to look at that slot.
+    """
+    tick = timer._tick
+    cur = self._tick
+    timer._queued = True
+    self._size += 1
+    for level in range(LEVELS):
+      shift = SLOT_BITS * level
+      if (tick >> (shift + SLOT_BITS)) == (cur >> (shift + SLOT_BITS)):
+        self._wheels[level][(tick >> shift) & SLOT_MASK].append(timer)
+        return (tick >> shift) << shift
+    self._overflow.append(timer)
+    top = SLOT_BITS * LEVELS
+    return ((cur >> top) + 1) << top
+
+  def next_tick (self):
+    """ Returns the next tick the wheel has any work to do at, or None. """
+    cur = self._tick
+    if cur is None: return None
+    for level in range(LEVELS):
+      shift = SLOT_BITS * level
+      slots = self._wheels[level]
+      for i in range((cur >> shift & SLOT_MASK) + 1, SLOTS):
+        if slots[i]:
+          return (cur >> (shift + SLOT_BITS) << (shift + SLOT_BITS)
+                  | i << shift)
+    if self._overflow:
+      top = SLOT_BITS * LEVELS
+      return ((cur >> top) + 1) << top
+    return None
+
+  def _schedule (self, tick):
+    self._sweep_tick = tick
+    # Timers ticking over don't count as activity for quiescence
+    self.world._add(tick * self.resolution,
+                    core.BackgroundEvent(self.world, self._sweep, (tick,), None))
+
+  def _sweep (self, tick):
+    if tick != self._sweep_tick:
+      # Superseded by an earlier sweep which rescheduled things
+      return
+    self._tick = tick
+
+    # Cascade anything that's now close enough down a level (or more)
+    top = SLOT_BITS * LEVELS
+    if tick & ((1 << top) - 1) == 0:
+      pending, self._overflow = self._overflow, []
+      for timer in self._take(pending):
+        self._place(timer)
+    for level in range(LEVELS - 1, 0, -1):
+      shift = SLOT_BITS * level
+      if tick & ((1 << shift) - 1) == 0:
+        slots = self._wheels[level]
+        i = tick >> shift & SLOT_MASK
+        pending, slots[i] = slots[i], []
+        for timer in self._take(pending):
+          self._place(timer)
+
+    # And fire everything which is due
+    slots = self._wheels[0]
+    i = tick & SLOT_MASK
+    due, slots[i] = slots[i], []
+    for timer in self._take(due):
+      if not timer.stopped:
+        timer.timeout()
+
+    self._sweep_tick = None
+    tick = self.next_tick()
+    if tick is not None:
+      self._schedule(tick)
@@ -0,0 +1,105 @@
+#!/bin/env python
+# Checks that entities which have been removed (or cleared out of the
+# registry) are gone from everything that goes through the topology --
+# including checkpoints and parallel runs -- and that their names can be
+# used again.
+
+import sys
+sys.path.append('.')
+
+_DISABLE_CONSOLE_LOG = True
+
+import sim.api as api
+import sim.core as core
+import sim.topo as topo
+import sim.checkpoint as checkpoint
+import sim.parallel as parallel
+from sim.basics import BasicHost
+from hub import Hub
+from rip_router import RIPRouter
+import scenarios.linear as linear
+import os
+import tempfile
+
+def check(what, ok):
+    if not ok:
+        print "FAILED:", what
+        os._exit(1)
+
+def topo_names():
+    return sorted(te.entity.name for te in core.topo.values())
+
+world = core.world
+world.virtual = True
+
+def build():
+    h1 = BasicHost.create('h1')
+    h2 = BasicHost.create('h2')
+    s1 = Hub.create('s1')
+    topo.link(h1, s1)
+    topo.link(h2, s1)
+    return h1, h2, s1
+
+# Removing one entity
+h1,h2,s1 = build()
+world.run_until(1)
+h2.remove()
+world.run_until(2)
+check("h2 is forgotten", 'h2' not in core.entities)
+check("h2 is out of the topology", topo_names() == ['h1', 's1'])
+check("h2's links are down", not core.topoOf(s1).isConnectedTo(h2))
+h2 = BasicHost.create('h2')
+check("h2 can be made again", topo_names() == ['h1', 'h2', 's1'])
+
+# Clearing everything to build it again
+core.entities.clear()
+check("nothing left", len(core.entities) == 0 and topo_names() == [])
+h1,h2,s1 = build()
+check("no duplicates", topo_names() == ['h1', 'h2', 's1'])
+world.run_until(3)
+check("the new ones are linked", core.topoOf(s1).isConnectedTo(h1))
+
+# Checkpoints leave out removed entities, even with their names reused
+h1.remove()
+h2.remove()
+h2 = BasicHost.create('h2')
+topo.link(h2, s1)
+f,path = tempfile.mkstemp(suffix=".sim")
+os.close(f)
+try:
+    checkpoint.save(path)
+    with core.Simulation(virtual=True):
+        checkpoint.load(path)
+        check("removed ones aren't loaded",
+              core.entities.names() == ['h2', 's1'])
+        check("only the live ones are in the topology",
+              topo_names() == ['h2', 's1'])
+        check("new IDs are new",
+              BasicHost.create('h3').entity_id > h2.entity_id)
+        core.world.run_until(10)
+        check("the old links went down after loading",
+              core.entities.get('s1')._topo._livePorts() == [2])
+finally:
+    os.remove(path)
+
+# Running in parallel with an entity removed (and its links still up)
+# gives the same tables as running it all here
+def collect(local):
+    return dict((e.name, sorted((d.name, c) for d,c in
+                                e.routing_table.best_costs.items()))
+                for e in local if isinstance(e, RIPRouter))
+def removed_h2():
+    linear.create(switch_type=RIPRouter, host_type=BasicHost, n=4)
+    core.entities.get('h2').remove()
+with core.Simulation(virtual=True):
+    removed_h2()
+    core.world.run_until(20)
+    serial = collect(core.entities.entities())
+with core.Simulation(virtual=True):
+    removed_h2()
+    r = parallel.simulate(2, until=20, collect=collect)
+    check("all the routers ran", sorted(r) == ['s1', 's2', 's3', 's4'])
+    check("same tables as running here", r == serial)
+
+print "PASSED"
+os._exit(0)
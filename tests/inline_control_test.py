@@ -0,0 +1,80 @@
+#!/bin/env python
+# Checks that the world can be paused and stepped from another thread (as
+# the GUI does) while a script runs it inline with run_until(), and that
+# the script's run still ends where it asked.
+
+import sys
+sys.path.append('.')
+
+_DISABLE_CONSOLE_LOG = True
+
+import sim.api as api
+import sim.core as core
+import os
+import threading
+import time
+
+def check(what, ok):
+    if not ok:
+        print "FAILED:", what
+        os._exit(1)
+
+world = core.world
+world.virtual = True
+
+log = []
+threads = set()
+def event(i):
+    log.append(i)
+    threads.add(threading.current_thread())
+    time.sleep(0.001)
+
+for i in range(1000):
+    world.doLater(i * 0.1, event, i)
+
+def wait_for(n):
+    while len(log) < n:
+        time.sleep(0.001)
+
+results = []
+def control():
+    try:
+        wait_for(100)
+        world.pause()
+        time.sleep(0.1)
+        n = len(log)
+        time.sleep(0.1)
+        results.append(("stays paused", len(log) == n))
+
+        world.step(50)
+        results.append(("stepped 50", len(log) == n + 50))
+        time.sleep(0.1)
+        results.append(("paused after stepping", len(log) == n + 50))
+
+        # Like the GUI, which doesn't wait
+        world.step(20, wait=False)
+        wait_for(n + 70)
+        time.sleep(0.1)
+        results.append(("paused after stepping again", len(log) == n + 70))
+
+        world.resume()
+    except:
+        results.append(("control thread", False))
+        raise
+
+t = threading.Thread(target=control)
+t.daemon = True
+t.start()
+world.run_until(100)
+t.join(10)
+
+check("control thread finished", not t.is_alive())
+for what,ok in results:
+    check(what, ok)
+check("ran to the end", world.now() == 100)
+check("everything happened once, in order", log == range(1000))
+check("all in the calling thread",
+      threads == set([threading.current_thread()]))
+
+print "PASSED"
+os._exit(0)
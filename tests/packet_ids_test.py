@@ -0,0 +1,62 @@
+#!/bin/env python
+# Checks that packets carry the IDs of their source and destination, so
+# that routers can keep tables indexed by ID.
+
+import sys
+sys.path.append('.')
+
+_DISABLE_CONSOLE_LOG = True
+
+import sim.api as api
+import sim.core as core
+import sim.topo as topo
+from sim.basics import BasicHost, Ping, RoutingUpdate
+import os
+
+def check(what, ok):
+    if not ok:
+        print "FAILED:", what
+        os._exit(1)
+
+class Router (api.Entity):
+    """ Forwards by destination ID, with its table in a list. """
+    def __init__(self):
+        self.table = []
+        self.got = []
+
+    def handle_rx(self, packet, port):
+        self.got.append(packet)
+        if isinstance(packet, Ping):
+            self.send(packet, self.table[packet.dst_id])
+
+world = core.world
+world.virtual = True
+
+h1 = BasicHost.create('h1')
+h2 = BasicHost.create('h2')
+r = Router.create('r')
+topo.link(h1, r)
+topo.link(r, h2)
+world.run_until(1)
+
+p = Ping(h2)
+check("dst_id is set", p.dst_id == h2.entity_id)
+check("src_id is -1 until sent", p.src_id == -1)
+
+r.table = [None] * core.entities.id_limit()
+r.table[h2.entity_id] = 1
+h1.send(p, 0)
+check("src_id is filled in on sending", p.src_id == h1.entity_id)
+world.run_until(2)
+pings = [g for g in r.got if isinstance(g, Ping)]
+check("the router got the ping", len(pings) == 1)
+check("the copy has the IDs", (pings[0].src_id, pings[0].dst_id) ==
+      (h1.entity_id, h2.entity_id))
+check("the ID finds the entity",
+      core.entities.by_id(pings[0].dst_id) is h2)
+
+u = RoutingUpdate()
+check("no destination is -1", u.dst_id == -1)
+
+print "PASSED"
+os._exit(0)
@@ -128,23 +128,25 @@ api.simlog.setLevel(logging.DEBUG)
 api.userlog.setLevel(logging.DEBUG)
 
 _DISABLE_CONSOLE_LOG = True
+_BUILTIN_NAMES = True
 
 create(switch)
-start = sim.core.simulate
-start()
-time.sleep(30)
+# Run in virtual time; the test exits as soon as a ping gets through
+world = sim.core.world
+world.virtual = True
+world.run_until(30)
 topo.unlink(s1, h1b)
 topo.unlink(s7, s6)
 topo.unlink(s3, s2)
-time.sleep(15)
+world.run_until(45)
 h2a.ping(h1a)
 print("first ping sent")
-time.sleep(15)
+world.run_until(60)
 h2a.ping(h1a)
 print("second ping sent")
-time.sleep(30)
+world.run_until(90)
 h2a.ping(h1a)
 print("third ping sent")
-time.sleep(30)
+world.run_until(120)
 print("TIMEOUT")
 os._exit(50)
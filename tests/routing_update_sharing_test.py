@@ -0,0 +1,76 @@
+#!/bin/env python
+# Checks that the copies of a RoutingUpdate sent out of each port don't
+# share their paths with the sender (or with each other).
+
+import sys
+sys.path.append('.')
+
+_DISABLE_CONSOLE_LOG = True
+
+import sim.api as api
+import sim.core as core
+import sim.topo as topo
+from sim.basics import RoutingUpdate
+import os
+
+class Sender (api.Entity):
+    def __init__(self):
+        self.table = {'x' : 1}
+
+class Receiver (api.Entity):
+    def __init__(self):
+        self.got = []
+
+    def handle_rx(self, packet, port):
+        if isinstance(packet, RoutingUpdate):
+            self.got.append(packet)
+
+def check(what, ok):
+    if not ok:
+        print "FAILED:", what
+        os._exit(1)
+
+a = Sender.create('a')
+b = Receiver.create('b')
+c = Receiver.create('c')
+topo.link(a, b)
+topo.link(a, c)
+
+world = core.world
+world.virtual = True
+world.run_until(5)
+
+# The sender changes its table after sending the update made from it
+u = RoutingUpdate()
+u.paths = a.table
+a.send(u, flood=True)
+a.table['x'] = 99
+world.run_until(10)
+check("b got the update", len(b.got) == 1)
+check("c got the update", len(c.got) == 1)
+check("b sees the paths as sent", b.got[0].get_distance('x') == 1)
+check("c sees the paths as sent", c.got[0].paths == {'x' : 1})
+check("the sender keeps its own dict", u.paths is a.table)
+
+# A receiver changes the paths it got
+b.got[0].paths['mine'] = 'b'
+c.got[0].paths['mine'] = 'c'
+check("the sender's table is untouched", a.table == {'x' : 99})
+check("b's change is its own", b.got[0].paths == {'x' : 1, 'mine' : 'b'})
+check("c's change is its own", c.got[0].paths == {'x' : 1, 'mine' : 'c'})
+
+# The same with an update built with add_destination (whose copies do
+# share one dict until somebody changes it)
+u = RoutingUpdate()
+u.add_destination('y', 2)
+a.send(u, flood=True)
+u.add_destination('z', 3)
+world.run_until(15)
+check("b got the second update", len(b.got) == 2)
+check("b sees the second update as sent", b.got[1].paths == {'y' : 2})
+c.got[1].paths['mine'] = 'c'
+check("b doesn't see c's change", b.got[1].paths == {'y' : 2})
+check("the sender sees its own change", u.paths == {'y' : 2, 'z' : 3})
+
+print "PASSED"
+os._exit(0)
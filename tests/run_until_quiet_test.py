@@ -0,0 +1,79 @@
+#!/bin/env python
+# Checks that run_until_quiet() keeps going after a link fails -- both in
+# a network that has just converged and in one loaded from a checkpoint --
+# and that the world runs once started after being run inline.
+
+import sys
+sys.path.append('.')
+
+_DISABLE_CONSOLE_LOG = True
+
+import sim.api as api
+import sim.core as core
+import sim.checkpoint as checkpoint
+import sim.topo as topo
+from sim.basics import BasicHost
+from rip_router import RIPRouter
+import scenarios.octagon as octagon
+import os
+import tempfile
+
+def check(what, ok):
+    if not ok:
+        print "FAILED:", what
+        os._exit(1)
+
+def tables():
+    r = {}
+    for name in core.entities.names():
+        e = core.entities.get(name)
+        if isinstance(e, RIPRouter):
+            r[name] = dict((k.name, v)
+                           for k,v in e.routing_table.best_costs.items())
+    return r
+
+def fail(a, b, control_only):
+    world = core.world
+    before = tables()
+    start = world.now()
+    topo.unlink(core.entities.get(a), core.entities.get(b))
+    t = world.run_until_quiet(control_only=control_only)
+    check("went quiet after %s-%s failed" % (a, b), t is not None)
+    check("quiet time isn't older than the failure", t >= start)
+    after = tables()
+    check("tables changed after %s-%s failed" % (a, b), after != before)
+    check("%s routes around the failure" % (a,), after[a][b] == 2)
+
+world = core.world
+world.virtual = True
+octagon.create(switch_type=RIPRouter, host_type=BasicHost, n=8)
+check("converged", world.run_until_quiet(control_only=True) is not None)
+check("s1 is next to s2", tables()['s1']['s2'] == 1)
+
+f,path = tempfile.mkstemp(suffix=".sim")
+os.close(f)
+try:
+    checkpoint.save(path)
+
+    fail('s1', 's2', True)
+    fail('s3', 's4', False)
+
+    # The same failure again, starting from the checkpoint
+    with core.Simulation(virtual=True):
+        checkpoint.load(path)
+        check("loaded", tables()['s1']['s2'] == 1)
+        fail('s1', 's2', True)
+finally:
+    os.remove(path)
+
+# Having been run inline (which leaves it paused), it runs freely once
+# started in its own thread
+check("left paused", world.paused)
+before = tables()
+topo.unlink(core.entities.get('s5'), core.entities.get('s6'))
+world.start()
+check("runs after start()", world.wait_quiet(30) is not None)
+check("tables changed after s5-s6 failed", tables() != before)
+
+print "PASSED"
+os._exit(0)
@@ -0,0 +1,87 @@
+#!/bin/env python
+# Checks when timers go off, and that the timer wheel keeps count of the
+# live and cancelled timers in it.
+
+import sys
+sys.path.append('.')
+
+_DISABLE_CONSOLE_LOG = True
+
+import sim.api as api
+import sim.core as core
+import os
+
+def check(what, ok):
+    if not ok:
+        print "FAILED:", what
+        os._exit(1)
+
+def close(a, b):
+    return abs(a - b) < 1e-9
+
+world = core.world
+world.virtual = True
+wheel = world.timers
+
+# Timers as much as an hour out (well past the top level of the wheel)
+fired = {}
+def fire(seconds):
+    fired.setdefault(seconds, []).append(api.current_time())
+delays = [0.001, 0.0015, 0.05, 0.064, 0.065, 1, 4.096, 4.097, 100.5, 3600]
+for seconds in delays:
+    api.create_timer(seconds, fire, recurring=False, args=(seconds,))
+every = []
+api.create_timer(0.25, lambda: every.append(api.current_time()))
+
+world.run_until(3601)
+for seconds in delays:
+    check("one-shot %s fired once" % (seconds,),
+          len(fired.get(seconds, ())) == 1)
+check("0.001 fired on time", close(fired[0.001][0], 0.001))
+# Deadlines are rounded up to the next tick (a millisecond)
+check("0.0015 fired on the next tick", close(fired[0.0015][0], 0.002))
+for seconds in delays[2:]:
+    check("%s fired on time" % (seconds,), close(fired[seconds][0], seconds))
+check("recurring timer fired every period", len(every) == 14404)
+check("recurring timer didn't drift", close(every[-1], 3601.0))
+
+# Cancelling some of a lot of timers
+world2 = core.Simulation(virtual=True)
+with world2:
+    wheel = world2.world.timers
+    fired = []
+    timers = [api.create_timer(1 + i * 0.01, fired.append, recurring=False,
+                               args=(i,))
+              for i in range(1000)]
+    # Outside the world thread, arming and cancelling happen as events
+    world2.world.run_until(0.5)
+    check("all armed", wheel._size == 1000 and wheel._dead == 0)
+    for t in timers[::2]:
+        t.cancel()
+        t.cancel()
+    world2.world.run_until(0.6)
+    check("cancelled ones are counted once",
+          wheel._size - wheel._dead == 500)
+    world2.world.run_until(20)
+    check("only the live ones fired", fired == range(1, 1000, 2))
+    check("wheel is empty", wheel._size == 0 and wheel._dead == 0)
+
+# Recurring timers which cancel themselves from their own callback
+world3 = core.Simulation(virtual=True)
+with world3:
+    wheel = world3.world.timers
+    counts = [0] * 100
+    def tick(timer, i):
+        counts[i] += 1
+        if counts[i] == 3:
+            timer.cancel()
+    for i in range(100):
+        api.create_timer(0.1, tick, pass_self=True, args=(i,))
+    world3.world.run_until(5)
+    check("each stopped after three", counts == [3] * 100)
+    check("nothing left in the wheel",
+          wheel._size == 0 and wheel._dead == 0)
+    check("no timers pending", world3.world.telemetry.queue_depth()[1] == 0)
+
+print "PASSED"
+os._exit(0)
@@ -11,6 +11,10 @@ _ENABLE_GUI = "--gui" in sys.argv
 # which displays logs itself.
 _DISABLE_CONSOLE_LOG = True
 
+# Make each entity a builtin with its name, so you can just type s1 (for
+# example) at the console.
+_BUILTIN_NAMES = True
+
 from rip_router import RIPRouter as switch
 from rip_router import RIPRouter
 
@@ -38,9 +42,9 @@ total = len(sys.argv)
 cmdargs = int(sys.argv[1])
 
 scenario.create(switch_type = switch, n = cmdargs)
-start = sim.core.simulate
 
-start()
-time.sleep(10)
+# Run just until the routing updates stop (no need to oversleep)
+sim.core.world.virtual = True
+sim.core.world.run_until_quiet(control_only = True)
 print(RIPRouter.updates_sent)
 